@@ -17,18 +17,26 @@
 See https://ai.google.dev/api/python/google/generativeai.
 """
 
+import asyncio
+import base64
 import collections
-from collections.abc import Mapping, Sequence
+from collections.abc import Awaitable, Callable, Mapping, Sequence
 import dataclasses
+import functools
+import hashlib
+import os
 import pprint
-from typing import Any, cast, Final
+import threading
+from typing import Any, cast, Final, TypeVar
 
 from absl import logging
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from google.generativeai.types import content_types
 from google.generativeai.types import generation_types
 from google.generativeai.types import safety_types
 import immutabledict
+import numpy as np
 from onetwo.backends import backends_base
 from onetwo.builtins import formatting
 from onetwo.builtins import llm
@@ -41,6 +49,7 @@ from onetwo.core import utils
 
 
 
+_T = TypeVar('_T')
 
 # Available models are listed at https://ai.google.dev/models/gemini.
 # input_token_limit=30720, output_token_limit=2048.
@@ -68,18 +77,220 @@ SAFETY_DISABLED: Final[Mapping[int, int]] = immutabledict.immutabledict({
 })
 
 
-def _truncate(text: str, max_tokens: int | None = None) -> str:
-  """Truncates text to the given number of tokens."""
-  # Unfortunately, when setting a max_output_tokens value in the API that is
-  # smaller than what the model would naturally generate, the response is
-  # empty with a finish_reason of "MAX_TOKENS". So we need to do post-hoc
-  # truncation.
-  # However we don't want to tokenize the answer in order to know its exact
-  # token length, so instead we approximately truncate by counting characters.
-  if max_tokens is None:
-    return text
-  else:
-    return text[:max_tokens * 3]
+def _jpeg_blob(chunk: content_lib.Chunk) -> content_types.BlobDict:
+  """Converts a Chunk containing image bytes into a GenAI blob."""
+  # If we have bytes we assume the image is in jpeg format.
+  # TODO: support other formats.
+  # BlobDict is a TypedDict so we can directly build a plain dict.
+  return {'mime_type': 'image/jpeg', 'data': cast(bytes, chunk.content)}
+
+
+# Conversion of Chunks into the content types expected by the GenAI API,
+# indexed by the chunk's content_type. Chunks with a content_type that is not
+# listed here are passed as is.
+_CHUNK_CONVERTERS: Final[
+    Mapping[str, Callable[[content_lib.Chunk], Any]]
+] = immutabledict.immutabledict({
+    'bytes': _jpeg_blob,
+    'image/jpeg': _jpeg_blob,
+})
+
+
+def _chunk_content(chunk: content_lib.Chunk) -> Any:
+  """Default conversion of a Chunk: its content is passed as is."""
+  return chunk.content
+
+
+@functools.lru_cache(maxsize=64)
+def _make_generation_config(
+    samples: int,
+    temperature: float | None,
+    stop: tuple[str, ...] | None,
+    top_k: int | None,
+    top_p: float | None,
+) -> genai.GenerationConfig:
+  """Returns a (shared) GenerationConfig for the given parameters.
+
+  The GenAI library copies the config into the request, so the returned object
+  can be reused across requests with identical parameters. It should not be
+  modified.
+
+  Args:
+    samples: Number of candidates to generate.
+    temperature: Temperature parameter for the generation.
+    stop: Stop sequences (as a tuple so that it can be used as a cache key).
+    top_k: Top-k parameter for the generation.
+    top_p: Top-p parameter for the generation.
+
+  Returns:
+    The GenerationConfig object.
+  """
+  return genai.GenerationConfig(
+      candidate_count=samples,
+      stop_sequences=stop,
+      # We handle truncation ourselves (the API truncation returns an empty
+      # response).
+      max_output_tokens=None,
+      temperature=temperature,
+      top_k=top_k,
+      top_p=top_p,
+  )
+
+
+# The GenAI library keeps a single client per service (and thus a single
+# persistent connection that is shared by all the requests, the async client
+# being used from a single event loop, see _run_in_client_loop), but calling
+# `genai.configure` discards these clients. We thus only configure the library
+# if the API key it currently uses (which may have been set by some other code,
+# or read from the environment) differs, so that creating new GeminiAPI
+# instances with the same key keeps reusing the existing connections.
+_configure_lock = threading.Lock()
+
+
+def _resolve_api_key(api_key: str | None) -> str | None:
+  """Returns the API key, read from the environment if not provided."""
+  if api_key is None:
+    # This is the key that genai.configure would use.
+    api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GOOGLE_API_KEY')
+  return api_key
+
+
+def _configure(api_key: str | None) -> None:
+  """Configures the GenAI library unless it is already using this API key."""
+  api_key = _resolve_api_key(api_key)
+  with _configure_lock:
+    # pylint: disable-next=protected-access
+    client_config = genai_client._client_manager.client_config
+    client_options = client_config.get('client_options')
+    if client_options is not None and (
+        getattr(client_options, 'api_key', None) == api_key
+    ):
+      return
+    genai.configure(api_key=api_key)
+
+
+# The async clients of the GenAI library use a grpc.aio channel, which is bound
+# to the event loop in which the client was created and fails once that loop is
+# closed (e.g. when a new loop is created by each call to `executing.run`). All
+# the calls to the async clients are thus sent from a single long-lived event
+# loop running in a background thread, so that the clients (and their
+# connections) are shared by all the runs and GeminiAPI instances.
+_client_loop: asyncio.AbstractEventLoop | None = None
+_client_loop_lock = threading.Lock()
+
+
+def _get_client_loop() -> asyncio.AbstractEventLoop:
+  """Returns the event loop from which the async clients are used."""
+  global _client_loop
+  with _client_loop_lock:
+    if _client_loop is None:
+      loop = asyncio.new_event_loop()
+      threading.Thread(
+          target=loop.run_forever, name='gemini_api_client_loop', daemon=True
+      ).start()
+      _client_loop = loop
+    return _client_loop
+
+
+async def _run_in_client_loop(coroutine: Awaitable[_T]) -> _T:
+  """Awaits a coroutine using the async clients from the running event loop.
+
+  Args:
+    coroutine: The coroutine to be run in the loop of the async clients.
+
+  Returns:
+    The result of the coroutine. Cancelling the caller cancels the coroutine.
+  """
+  return await asyncio.wrap_future(
+      asyncio.run_coroutine_threadsafe(coroutine, _get_client_loop())
+  )
+
+
+@functools.lru_cache(maxsize=4)
+def _list_models(api_key_hash: str) -> dict[str, Any]:
+  """Returns the available models for the (hash of the) configured API key.
+
+  Listing the models requires a call to the API, so we cache the result for a
+  given API key in order to avoid paying for it every time a GeminiAPI instance
+  is created.
+
+  Args:
+    api_key_hash: Hash of the API key with which the GenAI library is
+      configured. It is only used as the cache key.
+
+  Returns:
+    Mapping from model name to model information.
+  """
+  del api_key_hash
+  return {m.name: m for m in genai.list_models()}
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_to_content(role: str, text: str) -> Any:
+  """Returns a (shared) Content proto for a text message of the chat history.
+
+  In multi-turn chats the same history messages are sent again at every turn,
+  so we avoid rebuilding their protos. The returned object should not be
+  modified.
+
+  Args:
+    role: Role of the message ('user' or 'model').
+    text: Content of the message.
+
+  Returns:
+    The Content proto.
+  """
+  return content_types.to_content({'role': role, 'parts': [text]})
+
+
+# Unfortunately, when setting a max_output_tokens value in the API that is
+# smaller than what the model would naturally generate, the response is empty
+# with a finish_reason of "MAX_TOKENS". So we need to do post-hoc truncation.
+# However we don't want to tokenize the answer in order to know its exact token
+# length, so instead we approximately truncate by counting characters. The
+# truncation is inlined at the call sites as it is skipped in the (default)
+# case where max_tokens is None.
+_CHARS_PER_TOKEN: Final[int] = 3
+
+# Number of tokens that an image counts for in the Gemini models.
+_TOKENS_PER_IMAGE: Final[int] = 258
+
+
+def _approximate_token_count(content: str | content_lib.ChunkList) -> int:
+  """Estimates the number of tokens without calling the API.
+
+  Text is counted with the same characters-per-token ratio as the one used for
+  truncation, and any other type of chunk is assumed to be an image.
+
+  Args:
+    content: The content (string or ChunkList) to be tokenized.
+
+  Returns:
+    The approximate number of tokens.
+  """
+  if isinstance(content, str):
+    return -(-len(content) // _CHARS_PER_TOKEN)
+  return sum(
+      _approximate_token_count(chunk.content)
+      if isinstance(chunk.content, str)
+      else _TOKENS_PER_IMAGE
+      for chunk in content
+  )
+
+
+def _count_token_batches(method: Callable[..., Any]) -> Callable[..., Any]:
+  """Wraps GeminiAPI's batched count_tokens method to count the batches."""
+
+  @functools.wraps(method)
+  async def wrapper(
+      self: 'GeminiAPI', requests: Sequence[Any]
+  ) -> Sequence[Any]:
+    logging.info('Executing a batch of %d count_tokens requests', len(requests))
+    # pylint: disable-next=protected-access
+    self._num_count_tokens_batches += 1
+    return await method(self, requests)
+
+  return wrapper
 
 
 @batching.add_batching  # Methods of this class are batched.
@@ -90,31 +301,42 @@ class GeminiAPI(
 ):
   """Google GenAI API.
 
-  TODO: Implement streaming for generate_text and chat.
-  TODO: Implement embed.
-  TODO: Add rate limiting.
+  Streaming (see `enable_streaming`) is only supported by generate_texts, when
+  max_tokens is set and a single sample is requested.
 
   Attributes:
     disable_caching: Whether caching is enabled for this object (inherited from
       CacheEnabled).
     cache_filename: Name of the file (full path) where the cache is stored
-      (inherited from FileCacheEnabled)
+      (inherited from FileCacheEnabled). If it ends with `.sqlite`, the cache is
+      stored in an SQLite database which is updated incrementally.
     batch_size: Number of requests (generate_text or chat or generate_embedding)
-      that is grouped together when sending them to GenAI API. GenAI API does
-      not explicitly support batching (i.e. multiple requests can't be passed
-      via arguments). Instead we send multiple requests from separate threads.
+      that is grouped together when sending them to GenAI API. Embeddings of a
+      batch are computed with a single batchEmbedContents call. For the other
+      requests GenAI API does not explicitly support batching (i.e. multiple
+      requests can't be passed via arguments). Instead we send multiple
+      requests concurrently using the async client.
     api_key: GenAI API key string.
     api_key_file: Full quialified path to a file that contains GenAI API key on
       its first line. Only one of api_key or api_key_file can be provided. If
       neither of them is set, it is searched in the GOOGLE_API_KEY environment
       variable.
+    verify_models: Whether to check at construction time that the specified
+      models are available and support the required methods (this requires
+      listing the available models from the API, the result of which is cached
+      per API key).
     generate_model_name: Name of the model to use for `generate` requests.
     chat_model_name: Name of the model to use for `chat` requests.
     embed_model_name: Name of the model to use for `embed` requests. replies.
       Default is 1.
     enable_streaming: Whether to enable streaming replies from generate_text.
+      Streaming is only used when max_tokens is set (and a single sample is
+      requested), in which case we stop reading the reply as soon as enough
+      text was received. The `text` returned in the details is then the part of
+      the reply that was read.
     max_qps: Maximum queries per second for the backend (if None, no rate
-      limiting is applied).
+      limiting is applied). Bursts of up to max_qps queries are allowed (see
+      utils.TokenBucket).
     temperature: Temperature parameter (float) for LLM generation (can be set as
       a default and can be overridden per request).
     max_tokens: Maximum number of tokens to generate (can be set as a default
@@ -130,6 +352,7 @@ class GeminiAPI(
   batch_size: int = 1
   api_key: str | None = None
   api_key_file: str | None = None
+  verify_models: bool = True
   generate_model_name: str = DEFAULT_GENERATE_MODEL
   chat_model_name: str = DEFAULT_GENERATE_MODEL
   embed_model_name: str = DEFAULT_EMBED_MODEL
@@ -156,11 +379,43 @@ class GeminiAPI(
   _available_models: dict[str, Any] = dataclasses.field(
       init=False, default_factory=dict
   )
+  _rate_limiter: utils.TokenBucket | None = dataclasses.field(
+      init=False, default=None
+  )
+  # Futures for the API calls that are currently being processed, indexed by
+  # event loop and request key (see _single_flight).
+  _inflight: dict[tuple[int, str], asyncio.Future[Any]] = dataclasses.field(
+      init=False, default_factory=dict
+  )
   # Used for logging by the batching.add_logging wrapper function in
-  # batching.batch_method_with_threadpool decorator.
+  # batching.batch_method_with_asyncio decorator.
   _counters: collections.Counter[str] = dataclasses.field(
       init=False, default_factory=collections.Counter
   )
+  # Numbers of calls to the individual methods. Plain int attributes are
+  # cheaper to update than Counter entries, use `counters` to read them.
+  _num_generate_texts: int = dataclasses.field(init=False, default=0)
+  _num_chat: int = dataclasses.field(init=False, default=0)
+  _num_embed: int = dataclasses.field(init=False, default=0)
+  _num_embed_batches: int = dataclasses.field(init=False, default=0)
+  _num_count_tokens: int = dataclasses.field(init=False, default=0)
+  _num_count_tokens_batches: int = dataclasses.field(init=False, default=0)
+
+  @property
+  def counters(self) -> collections.Counter[str]:
+    """Returns the numbers of method calls and of processed batches."""
+    return (
+        collections.Counter({
+            'generate_texts': self._num_generate_texts,
+            'chat': self._num_chat,
+            'embed': self._num_embed,
+            'embed_batches': self._num_embed_batches,
+            'count_tokens': self._num_count_tokens,
+            'count_tokens_batches': self._num_count_tokens_batches,
+        })
+        # Adding counters drops the zero entries.
+        + self._counters
+    )
 
   def register(self, name: str | None = None) -> None:
     """See parent class."""
@@ -207,19 +462,26 @@ class GeminiAPI(
     if self.api_key:
       return self.api_key
     if self.api_key_file is not None:
-      if not os.path.exists(self.api_key_file):
-        raise ValueError(f'File {self.api_key_file} does not exist.')
-      with open(self.api_key_file, 'r') as f:
-        return f.readline().strip()
+      # Simply attempt to open the file (rather than checking for its existence
+      # first), which saves a syscall and is not subject to races.
+      try:
+        with open(self.api_key_file, 'r') as f:
+          return f.readline().strip()
+      except FileNotFoundError as err:
+        raise ValueError(f'File {self.api_key_file} does not exist.') from err
     return None
 
-  def _verify_available_models(self):
+  def _verify_available_models(self, api_key: str | None) -> None:
     """Verify that specified models are available and support all methods."""
-    available_models = {m.name: m for m in genai.list_models()}
-    logging.info('Available models:')
-    for model_name, model in available_models.items():
-      logging.info('Model: %s', model_name)
-      logging.info('%s', pprint.pformat(model))
+    available_models = _list_models(
+        hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
+    )
+    logging.info('Available models: %s', ', '.join(available_models))
+    # Pretty-printing the full model information is expensive, we only do it
+    # when debug logging is enabled.
+    if logging.level_debug():
+      for model in available_models.values():
+        logging.debug('%s', pprint.pformat(model))
     self._available_models = available_models
     # TODO: Consider checking availability only for the models that
     # the user is planning to use. Revisit after the "API CL".
@@ -247,6 +509,9 @@ class GeminiAPI(
       raise ValueError(
           f'Model {self.embed_model_name} does not support embedContent.'
       )
+
+  def _create_models(self) -> None:
+    """Creates the models used by the various methods."""
     generation_config = genai.GenerationConfig(
         candidate_count=1,  # Using 1 as the default.
         stop_sequences=self.stop,
@@ -278,71 +543,148 @@ class GeminiAPI(
 
   def __post_init__(self) -> None:
     # Create cache.
-    self._cache_handler = caching.SimpleFunctionCache(
-        cache_filename=self.cache_filename,
-    )
-    # Register GenAI API key.
-    api_key = self._get_api_key()
-    genai.configure(api_key=api_key)
+    if self.cache_filename and self.cache_filename.endswith('.sqlite'):
+      # Values are persisted incrementally instead of rewriting a JSON file.
+      self._cache_handler = caching.SqliteFunctionCache(
+          cache_filename=self.cache_filename,
+      )
+    else:
+      self._cache_handler = caching.SimpleFunctionCache(
+          cache_filename=self.cache_filename,
+      )
+    # Create the rate limiter shared by all the API calls.
+    if self.max_qps is not None:
+      self._rate_limiter = utils.TokenBucket(
+          rate=self.max_qps, capacity=max(1.0, self.max_qps)
+      )
+    # Register GenAI API key (resolved here so that the models listed for a key
+    # from the environment are not reused for another one).
+    api_key = _resolve_api_key(self._get_api_key())
+    _configure(api_key)
     # Check available models.
-    self._verify_available_models()
+    if self.verify_models:
+      self._verify_available_models(api_key)
+    self._create_models()
+
+  async def _single_flight(
+      self, key: str, call: Callable[[], Awaitable[_T]]
+  ) -> _T:
+    """Awaits call() unless an identical call is already being processed.
+
+    The cache only catches duplicate requests once they have been processed.
+    This is used for deterministic API calls so that concurrent identical
+    requests (e.g. within a batch, or when caching is disabled) are sent only
+    once, the other callers awaiting the result of the first one.
+
+    Args:
+      key: Key identifying the request (identical requests have the same key).
+      call: Function returning the awaitable that sends the request.
+
+    Returns:
+      The result of the (possibly shared) call.
+    """
+    loop = asyncio.get_running_loop()
+    inflight_key = (id(loop), key)
+    future = self._inflight.get(inflight_key)
+    if future is not None:
+      return await asyncio.shield(future)
+    future = loop.create_future()
+    self._inflight[inflight_key] = future
+    try:
+      result = await call()
+    except Exception as err:  # pylint: disable=broad-except
+      future.set_exception(err)
+      # Mark the exception as retrieved in case nobody else awaits it.
+      future.exception()
+      raise
+    else:
+      future.set_result(result)
+      return result
+    finally:
+      del self._inflight[inflight_key]
+      if not future.done():
+        # The call was interrupted by a BaseException (e.g. it was cancelled),
+        # the other callers must not wait forever.
+        future.cancel()
+
+  async def _acquire_quota(self) -> None:
+    """Waits until an API call can be sent without exceeding max_qps."""
+    if self._rate_limiter is not None:
+      await self._rate_limiter.acquire()
 
-  @utils.rate_limit_method(qps=utils.FromInstance('max_qps'))
-  def _generate_content(
+  async def _generate_content(
       self,
       *,
-      prompt: str | content_lib.ChunkList,
+      prompt: str | content_lib.ChunkList | Sequence[Any],
       samples: int = 1,
       temperature: float | None = None,
       stop: Sequence[str] | None = None,
       top_k: int | None = None,
       top_p: float | None = None,
+      model: genai.GenerativeModel | None = None,
+      stream: bool = False,
       **kwargs,  # Optional genai specific arguments.
-  ) -> generation_types.GenerateContentResponse:
-    """Generate content."""
+  ) -> (
+      generation_types.GenerateContentResponse
+      | generation_types.AsyncGenerateContentResponse
+  ):
+    """Generate content.
+
+    Args:
+      prompt: The prompt, or a sequence of contents (e.g. the turns of a chat).
+      samples: Number of candidates to generate.
+      temperature: Temperature parameter for the generation.
+      stop: Stop sequences.
+      top_k: Top-k parameter for the generation.
+      top_p: Top-p parameter for the generation.
+      model: The model to use, defaults to the one for generate_text.
+      stream: If True, the response is streamed and only its first chunk has
+        been received when this method returns.
+      **kwargs: Optional genai specific arguments.
+
+    Returns:
+      The response, which is guaranteed to contain at least one non-empty
+      candidate (unless streamed, in which case the caller should check it).
+    """
+    if model is None:
+      model = self._generate_model
     if isinstance(prompt, content_lib.ChunkList):
-      converted = []
-      for c in prompt:
-        match c.content_type:
-          case 'str':
-            converted.append(c.content)
-          case 'bytes' | 'image/jpeg':
-            # If we have bytes we assume the image is in jpeg format.
-            # TODO: support other formats.
-            converted.append(
-                content_types.BlobDict(
-                    mime_type='image/jpeg', data=cast(bytes, c.content)
-                )
-            )
-          case _:
-            converted.append(c.content)
-      prompt = converted
+      prompt = [
+          _CHUNK_CONVERTERS.get(c.content_type, _chunk_content)(c)
+          for c in prompt
+      ]
 
-    generation_config = genai.GenerationConfig(
-        candidate_count=samples,
-        stop_sequences=stop,
-        max_output_tokens=None,
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
+    generation_config = _make_generation_config(
+        samples,
+        temperature,
+        tuple(stop) if stop else None,
+        top_k,
+        top_p,
     )
+    await self._acquire_quota()
     try:
       # TODO: Trace this external API call.
-      response = self._generate_model.generate_content(
-          prompt,
-          generation_config=generation_config,
-          **kwargs,
+      response = await _run_in_client_loop(
+          model.generate_content_async(
+              prompt,
+              generation_config=generation_config,
+              stream=stream,
+              **kwargs,
+          )
       )
     except Exception as err:  # pylint: disable=broad-except
       raise ValueError(
           f'GeminiAPI.generate_content raised err:\n{err}\n'
           f'for request:\n{pprint.pformat(prompt)[:100]}'
       ) from err
-    empty = True
-    for candidate in response.candidates:
-      if candidate and candidate.content.parts:
-        empty = False
-    if empty:
+    if stream:
+      # The candidates can only be checked once the stream was consumed.
+      return response
+    # Stops at the first non-empty candidate, i.e. usually the first one.
+    if not any(
+        candidate and candidate.content.parts
+        for candidate in response.candidates
+    ):
       response_msg = pprint.pformat(response.candidates)
       raise ValueError(
           'GeminiAPI.generate_text returned no answers. This may be caused '
@@ -350,16 +692,7 @@ class GeminiAPI(
       )
     return response
 
-  @caching.cache_method(  # Cache this method.
-      name='generate_text',
-      is_sampled=True,  # Two calls with same args may return different replies.
-      cache_key_maker=lambda: caching.CacheKeyMaker(hashed=['prompt']),
-  )
-  @batching.batch_method_with_threadpool(
-      batch_size=utils.FromInstance('batch_size'),
-      wrapper=batching.add_logging,
-  )
-  def generate_text(
+  async def generate_text(
       self,
       prompt: str | content_lib.ChunkList,
       *,
@@ -372,30 +705,31 @@ class GeminiAPI(
       **kwargs,  # Optional genai specific arguments.
   ) -> str | tuple[str, Mapping[str, Any]]:
     """See builtins.llm.generate_text."""
-    self._counters['generate_text'] += 1
-    response = self._generate_content(
-        prompt=prompt,
-        samples=1,
+    # This is generate_texts with a single sample, and hence shares its caching
+    # and batching (with `samples=1` as part of the cache key).
+    results = await self.generate_texts(
+        prompt,
+        1,
         temperature=temperature,
+        max_tokens=max_tokens,
         stop=stop,
         top_k=top_k,
         top_p=top_p,
+        include_details=include_details,
         **kwargs,
     )
-    raw = response.text
-    truncated = _truncate(raw, max_tokens)
-    return (truncated, {'text': raw}) if include_details else truncated
+    return results[0]
 
   @caching.cache_method(  # Cache this method.
       name='generate_texts',
       is_sampled=True,  # Two calls with same args may return different replies.
       cache_key_maker=lambda: caching.CacheKeyMaker(hashed=['prompt']),
   )
-  @batching.batch_method_with_threadpool(
+  @batching.batch_method_with_asyncio(
       batch_size=utils.FromInstance('batch_size'),
       wrapper=batching.add_logging,
   )
-  def generate_texts(
+  async def generate_texts(
       self,
       prompt: str | content_lib.ChunkList,
       samples: int = 1,
@@ -409,25 +743,118 @@ class GeminiAPI(
       **kwargs,  # Optional genai specific arguments.
   ) -> Sequence[str | tuple[str, Mapping[str, Any]]]:
     """See builtins.llm.generate_texts."""
-    self._counters['generate_texts'] += 1
-    response = self._generate_content(
-        prompt=prompt,
-        samples=samples,
-        temperature=temperature,
-        stop=stop,
-        top_k=top_k,
-        top_p=top_p,
-        **kwargs,
-    )
-    results = []
-    for candidate in response.candidates:
-      if candidate and candidate.content.parts:
-        raw = candidate.content.parts[0].text
-        truncated = _truncate(raw, max_tokens)
-        results.append(
-            truncated if not include_details else (truncated, {'text': raw})
+    self._num_generate_texts += 1
+    if self.enable_streaming and max_tokens is not None and samples == 1:
+      raw_texts = [
+          await self._generate_streamed_text(
+              prompt=prompt,
+              max_chars=max_tokens * _CHARS_PER_TOKEN,
+              temperature=temperature,
+              stop=stop,
+              top_k=top_k,
+              top_p=top_p,
+              **kwargs,
+          )
+      ]
+    else:
+      raw_texts = await self._generate_raw_texts(
+          prompt=prompt,
+          samples=samples,
+          temperature=temperature,
+          stop=stop,
+          top_k=top_k,
+          top_p=top_p,
+          **kwargs,
+      )
+    if max_tokens is None:
+      truncated_texts = raw_texts
+    else:
+      max_chars = max_tokens * _CHARS_PER_TOKEN
+      truncated_texts = [raw[:max_chars] for raw in raw_texts]
+    if not include_details:
+      return truncated_texts
+    return [
+        (truncated, {'text': raw})
+        for truncated, raw in zip(truncated_texts, raw_texts)
+    ]
+
+  async def _generate_raw_texts(self, **kwargs) -> list[str]:
+    """Returns the texts of all the non-empty candidates of the reply.
+
+    Args:
+      **kwargs: Arguments of _generate_content.
+    """
+    response = await self._generate_content(**kwargs)
+    # Accessing proto attributes is relatively slow, so we read the candidates
+    # once and extract all the texts in a single pass.
+    return [
+        ''.join(part.text for part in parts)
+        for parts in (
+            candidate.content.parts
+            for candidate in response.candidates
+            if candidate
         )
-    return results
+        if parts
+    ]
+
+  async def _generate_streamed_text(self, max_chars: int, **kwargs) -> str:
+    """Streams a single reply and stops reading it after max_chars characters.
+
+    Since the reply is truncated to max_chars anyway, this saves waiting for
+    (and transferring) the remainder of the generation.
+
+    Args:
+      max_chars: Number of characters after which we stop reading the reply.
+      **kwargs: Arguments of _generate_content.
+
+    Returns:
+      The text received so far (which may be longer than max_chars).
+
+    Raises:
+      ValueError: If the reply is empty.
+    """
+    response = await self._generate_content(stream=True, **kwargs)
+
+    async def read() -> list[str]:
+      texts = []
+      num_chars = 0
+      chunks = aiter(response)
+      try:
+        async for chunk in chunks:
+          if not chunk.candidates:
+            continue
+          text = ''.join(
+              part.text for part in chunk.candidates[0].content.parts
+          )
+          texts.append(text)
+          num_chars += len(text)
+          if num_chars >= max_chars:
+            # Stop consuming the stream, the rest of the reply would be
+            # discarded.
+            break
+      except Exception as err:  # pylint: disable=broad-except
+        raise ValueError(
+            f'GeminiAPI.generate_content raised err:\n{err}\n'
+            f'for request:\n{pprint.pformat(kwargs.get("prompt"))[:100]}'
+        ) from err
+      finally:
+        # Close the stream rather than waiting for it to be garbage collected,
+        # the underlying call is then released.
+        await chunks.aclose()
+        # pylint: disable-next=protected-access
+        stream = getattr(response, '_iterator', None)
+        if hasattr(stream, 'aclose'):
+          await stream.aclose()
+      return texts
+
+    # The stream is read by the async client, i.e. from its event loop.
+    texts = await _run_in_client_loop(read())
+    if not any(texts):
+      raise ValueError(
+          'GeminiAPI.generate_text returned no answers. This may be caused '
+          'by safety filters.'
+      )
+    return ''.join(texts)
 
   async def chat(
       self,
@@ -447,21 +874,20 @@ class GeminiAPI(
       is_sampled=True,
       cache_key_maker=lambda: caching.CacheKeyMaker(hashed=['messages']),
   )
-  @batching.batch_method_with_threadpool(
+  @batching.batch_method_with_asyncio(
       batch_size=utils.FromInstance('batch_size'),
       wrapper=batching.add_logging,
   )
-  def chat_via_api(
+  async def chat_via_api(
       self,
       messages: Sequence[content_lib.Message],
       **kwargs,
   ) -> str:
     """See builtins.llm.chat."""
-    # TODO: The send_message method does not support parameters
-    # like temperature, top_k, top_p, etc. so they are just ignored. We should
-    # issue a warning to the user if they are set.
+    # TODO: Parameters like temperature, top_k, top_p, etc. are
+    # ignored, they could be passed to _generate_content.
     del kwargs
-    self._counters['chat'] += 1
+    self._num_chat += 1
 
     last_message_index = len(messages)-1
     if messages[last_message_index].role == content_lib.PredefinedRole.MODEL:
@@ -475,38 +901,93 @@ class GeminiAPI(
         # TODO: Support SYSTEM messages.
         continue
       role = 'user' if msg.role == content_lib.PredefinedRole.USER else 'model'
+      if isinstance(msg.content, str):
+        history.append(_text_to_content(role, msg.content))
+      else:
+        history.append(
+            content_types.to_content({'role': role, 'parts': [msg.content]})
+        )
+    last_content = messages[last_message_index].content
+    if isinstance(last_content, str):
+      history.append(_text_to_content('user', last_content))
+    else:
       history.append(
-          content_types.to_content({'role': role, 'parts': [msg.content]})
+          content_types.to_content({'role': 'user', 'parts': [last_content]})
       )
-    generation_config = genai.GenerationConfig(
-        candidate_count=1,
+    # The whole conversation is sent in a single stateless request (rather than
+    # via a ChatSession), which shares the rate limiting and checks for empty
+    # responses with generate_text.
+    response = await self._generate_content(
+        prompt=history, model=self._chat_model
     )
-    # TODO: Trace this external API call.
-    chat = self._chat_model.start_chat(history=history)
-    response = chat.send_message(
-        content=messages[last_message_index].content,
-        generation_config=generation_config,
-    )
-
     return response.text
 
   @caching.cache_method(  # Cache this deterministic method.
-      name='embed',
+      # The cached values are base64-encoded float32 vectors (see below), the
+      # name differs from the one used when plain lists were cached.
+      name='embed_float32',
       is_sampled=False,
       cache_key_maker=lambda: caching.CacheKeyMaker(hashed=['content']),
   )
-  @batching.batch_method_with_threadpool(
-      batch_size=utils.FromInstance('batch_size'),
-      wrapper=batching.add_logging,
+  @batching.batchable_method(
+      implementation=utils.FromInstance('_embed_batch')
   )
-  def embed(self, content: str | content_lib.ChunkList) -> Sequence[float]:
-    """See builtins.llm.embed."""
-    self._counters['embed'] += 1
+  async def _embed_encoded(  # pytype: disable=bad-return-type
+      self, content: str | content_lib.ChunkList
+  ) -> str:
+    """Returns the embedding as base64-encoded float32 bytes.
+
+    This is what gets cached: it is about 5 times more compact than a list of
+    python floats while remaining serializable to JSON. The calls are
+    redirected to `_embed_batch`.
+
+    Args:
+      content: The content (string or ChunkList) to be embedded.
+    """
+    del content  # The implementation is provided by `_embed_batch`.
+
+  @batching.batch_method(batch_size=utils.FromInstance('batch_size'))
+  async def _embed_batch(
+      self, requests: Sequence[Mapping[str, Any]]
+  ) -> Sequence[str]:
+    """Embeds a batch of contents with a single API call.
+
+    Args:
+      requests: Arguments of the `_embed_encoded` calls forming the batch.
 
+    Returns:
+      The encoded embeddings, in the same order as the requests.
+    """
+    self._num_embed += len(requests)
+    self._num_embed_batches += 1
+    await self._acquire_quota()
     # TODO: Trace this external API call.
-    return genai.embed_content(
-        model=self.embed_model_name,
-        content=content,
+    # Passing a list of contents triggers a single batchEmbedContents call.
+    response = await _run_in_client_loop(
+        genai.embed_content_async(
+            model=self.embed_model_name,
+            content=[request['content'] for request in requests],
+        )
+    )
+    return [
+        base64.b64encode(
+            np.asarray(embedding, dtype=np.float32).tobytes()
+        ).decode('ascii')
+        for embedding in response['embedding']
+    ]
+
+  async def embed(self, content: str | content_lib.ChunkList) -> np.ndarray:
+    """See builtins.llm.embed.
+
+    Args:
+      content: The content (string or ChunkList) to be embedded.
+
+    Returns:
+      The embedding as a 1-D float32 array.
+    """
+    encoded = await self._embed_encoded(content)
+    return np.frombuffer(
+        bytearray(base64.b64decode(encoded)), dtype=np.float32
     )
 
   @caching.cache_method(  # Cache this method.
@@ -514,20 +995,50 @@ class GeminiAPI(
       is_sampled=False,  # Method is deterministic.
       cache_key_maker=lambda: caching.CacheKeyMaker(hashed=['content']),
   )
-  @batching.batch_method_with_threadpool(
+  @batching.batch_method_with_asyncio(
       batch_size=utils.FromInstance('batch_size'),
-      wrapper=batching.add_logging,
+      wrapper=_count_token_batches,
   )
-  def count_tokens(self, content: str | content_lib.ChunkList) -> int:
-    """See builtins.llm.count_tokens."""
-    self._counters['count_tokens'] += 1
+  async def _count_tokens_via_api(
+      self, content: str | content_lib.ChunkList
+  ) -> int:
+    """Returns the exact number of tokens, as counted by the API."""
+    self._num_count_tokens += 1
 
-    try:
+    async def call() -> Any:
+      await self._acquire_quota()
       # TODO: Trace this external API call.
-      response = self._generate_model.count_tokens(content)
+      return await _run_in_client_loop(
+          self._generate_model.count_tokens_async(content)
+      )
+
+    try:
+      response = await self._single_flight(
+          f'count_tokens:{utils.get_str_hash(content)}', call
+      )
     except Exception as err:  # pylint: disable=broad-except
       raise ValueError(
           f'GeminiAPI.count_tokens raised err:\n{err}\n'
           f'for request:\n{pprint.pformat(content)[:100]}'
       ) from err
     return response.total_tokens
+
+  async def count_tokens(
+      self,
+      content: str | content_lib.ChunkList,
+      approximate: bool = False,
+  ) -> int:
+    """See builtins.llm.count_tokens.
+
+    Args:
+      content: The content (string or ChunkList) to be tokenized.
+      approximate: If True, the number of tokens is estimated locally (see
+        _approximate_token_count) instead of sending a request to the API.
+
+    Returns:
+      The number of tokens.
+    """
+    if approximate:
+      return _approximate_token_count(content)
+    return await self._count_tokens_via_api(content)
+
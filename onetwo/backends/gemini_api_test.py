@@ -14,18 +14,25 @@
 
 """Tests for GeminiAPI engine."""
 
+import asyncio
 import collections
+from collections.abc import AsyncIterator
+import os
 import string
+import time
 from typing import Any, Counter, Final, TypeAlias
 import unittest
 from unittest import mock
 
+from absl import flags
 from absl.testing import absltest
 from absl.testing import parameterized
 from google import generativeai
+from google.api_core import client_options as client_options_lib
 from google.ai import generativelanguage as glm
 from google.generativeai import client
 from google.generativeai.types import model_types
+import numpy as np
 from onetwo.backends import gemini_api
 from onetwo.builtins import llm
 from onetwo.core import caching
@@ -46,9 +53,12 @@ _BATCH_SIZE: Final[int] = 4
 _MOCK_COUNT_TOKENS_RETURN: Final[int] = 5
 
 
-def _mock_configure(api_key: str) -> None:
-  del api_key  # Not used.
-  pass
+def _mock_configure(api_key: str | None) -> None:
+  # Records the API key and discards the clients like genai.configure does.
+  client._client_manager.client_config = {
+      'client_options': client_options_lib.ClientOptions(api_key=api_key)
+  }
+  client._client_manager.clients = {}
 
 
 def _mock_list_models() -> model_types.ModelsIterable:
@@ -79,6 +89,28 @@ def _mock_list_models() -> model_types.ModelsIterable:
   ]
 
 
+class _LoopBoundClient:
+  """Forwards the calls to a client, which only works from one event loop.
+
+  This mimics the GenAI async clients, whose grpc.aio channel is bound to the
+  event loop in which they were created.
+  """
+
+  def __init__(self, wrapped: Any):
+    self._wrapped = wrapped
+    self._loop = asyncio.get_running_loop()
+
+  def __getattr__(self, name: str) -> Any:
+    method = getattr(self._wrapped, name)
+
+    async def call(*args, **kwargs) -> Any:
+      if asyncio.get_running_loop() is not self._loop:
+        raise RuntimeError('Event loop is closed')
+      return await method(*args, **kwargs)
+
+    return call
+
+
 def _get_and_register_backend() -> gemini_api.GeminiAPI:
   """Get an instance of GeminiAPI and register its methods."""
   backend = gemini_api.GeminiAPI(
@@ -114,7 +146,10 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     # implementations to make sure they are set properly.
     llm.reset_defaults()
 
-    # Mock configure.
+    # Mock configure (and start from an unconfigured library).
+    self.enter_context(
+        mock.patch.object(client._client_manager, 'client_config', {})
+    )
     self.mock_configure = self.enter_context(
         mock.patch.object(
             generativeai,
@@ -123,7 +158,8 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
             side_effect=_mock_configure,
         )
     )
-    # Mock list_models.
+    # Mock list_models (and make sure results from other tests aren't reused).
+    gemini_api._list_models.cache_clear()
     self.mock_list_models = self.enter_context(
         mock.patch.object(
             generativeai,
@@ -133,8 +169,23 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
         )
     )
 
+    # GeminiAPI uses the async client of the GenAI library (from its own loop).
     self.client = unittest.mock.MagicMock()
-    client._client_manager.clients['generative'] = self.client
+    self.num_async_clients = 0
+
+    def make_client(name: str) -> _LoopBoundClient:
+      self.assertEqual(name, 'generative_async')
+      self.num_async_clients += 1
+      return _LoopBoundClient(self.client)
+
+    self.enter_context(
+        mock.patch.object(client._client_manager, 'clients', {})
+    )
+    self.enter_context(
+        mock.patch.object(
+            client._client_manager, 'make_client', side_effect=make_client
+        )
+    )
 
     def add_client_method(f):
       name = f.__name__
@@ -142,7 +193,7 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
       return f
 
     @add_client_method
-    def generate_content(  # pylint: disable=unused-variable
+    async def generate_content(  # pylint: disable=unused-variable
         request: glm.GenerateContentRequest,
     ) -> glm.GenerateContentResponse:
       self.assertIsInstance(request, glm.GenerateContentRequest)
@@ -153,6 +204,11 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
             'GenAI.Model.generate_content raised err:\nFake error\n'
             'for request:\nFake request.'
         )
+      if prompt[0].parts[0].text.startswith('empty_response'):
+        # This is what we get when the safety filters block the answers.
+        return glm.GenerateContentResponse(
+            {'candidates': [{'finish_reason': 'SAFETY'}] * candidate_count}
+        )
       letters = [string.ascii_lowercase[i % 26] for i in range(candidate_count)]
       candidates = [
           {'content': {'parts': [{'text': letter * 10}]}} for letter in letters
@@ -161,15 +217,107 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
           {'candidates': candidates}
       )
 
+    self.num_streamed_chunks = 0
+    self.is_stream_closed = False
+
+    @add_client_method
+    async def stream_generate_content(  # pylint: disable=unused-variable
+        request: glm.GenerateContentRequest,
+    ) -> AsyncIterator[glm.GenerateContentResponse]:
+      self.assertIsInstance(request, glm.GenerateContentRequest)
+
+      async def stream():
+        try:
+          # Ten chunks of 'abc'.
+          for i in range(10):
+            if i and request.contents[0].parts[0].text == 'raise_in_stream':
+              raise ValueError('Fake stream error')
+            self.num_streamed_chunks += 1
+            yield glm.GenerateContentResponse(
+                {'candidates': [{'content': {'parts': [{'text': 'abc'}]}}]}
+            )
+        finally:
+          self.is_stream_closed = True
+
+      return stream()
+
+    self.num_count_tokens_api_calls = 0
+
     @add_client_method
-    def count_tokens(  # pylint: disable=unused-variable
+    async def count_tokens(  # pylint: disable=unused-variable
         request: glm.CountTokensRequest,
     ) -> glm.CountTokensResponse:
       self.assertIsInstance(request, glm.CountTokensRequest)
+      self.num_count_tokens_api_calls += 1
+      # Give the opportunity to other requests to be sent concurrently.
+      await asyncio.sleep(0.01)
       return glm.CountTokensResponse(
           total_tokens=_MOCK_COUNT_TOKENS_RETURN
       )
 
+  def test_configure_reuses_clients_for_same_api_key(self):
+    _ = gemini_api.GeminiAPI(api_key='some_key')
+    _ = gemini_api.GeminiAPI(api_key='some_key')
+    with self.subTest('configures_once_for_same_key'):
+      self.mock_configure.assert_called_once_with(api_key='some_key')
+    _ = gemini_api.GeminiAPI(api_key='other_key')
+    with self.subTest('reconfigures_for_new_key'):
+      self.assertEqual(self.mock_configure.call_count, 2)
+    generativeai.configure(api_key='key_set_elsewhere')
+    _ = gemini_api.GeminiAPI(api_key='other_key')
+    with self.subTest('reconfigures_after_configure_elsewhere'):
+      self.assertEqual(self.mock_configure.call_count, 4)
+    with mock.patch.dict(
+        os.environ, {'GEMINI_API_KEY': '', 'GOOGLE_API_KEY': 'env_key'}
+    ):
+      _ = gemini_api.GeminiAPI()
+      _ = gemini_api.GeminiAPI()
+    with self.subTest('reconfigures_for_new_key_from_environment'):
+      self.assertEqual(self.mock_configure.call_count, 5)
+      self.mock_configure.assert_called_with(api_key='env_key')
+
+  def test_instances_with_same_api_key_share_async_client(self):
+    for api_key in ('some_key', 'some_key', 'other_key'):
+      backend = gemini_api.GeminiAPI(api_key=api_key)
+      _ = executing.run(backend.count_tokens('Something'))
+    with self.subTest('reuses_client_for_same_key'):
+      self.assertEqual(self.num_async_clients, 2)
+
+  def test_api_key_file(self):
+    # The `self.create_tempfile` method uses command line flags, which are not
+    # marked as parsed by default when running with pytest.
+    flags.FLAGS.mark_as_parsed()
+    api_key_file = self.create_tempfile(content='key_from_file\nsecond_line')
+    _ = gemini_api.GeminiAPI(api_key_file=api_key_file.full_path)
+    with self.subTest('reads_key_from_first_line'):
+      self.mock_configure.assert_called_once_with(api_key='key_from_file')
+    with self.subTest('raises_for_missing_file'):
+      with self.assertRaisesRegex(ValueError, 'does not exist'):
+        _ = gemini_api.GeminiAPI(api_key_file='/non/existing/file')
+
+  def test_list_models_is_cached(self):
+    _ = gemini_api.GeminiAPI(api_key='some_key')
+    _ = gemini_api.GeminiAPI(api_key='some_key')
+    with self.subTest('lists_models_once_for_same_key'):
+      self.mock_list_models.assert_called_once()
+    _ = gemini_api.GeminiAPI(api_key='some_key', verify_models=False)
+    with self.subTest('does_not_list_models_without_verification'):
+      self.mock_list_models.assert_called_once()
+
+  def test_list_models_is_cached_per_key_from_environment(self):
+    for env_key in ('env_key', 'env_key', 'other_env_key'):
+      with mock.patch.dict(
+          os.environ, {'GEMINI_API_KEY': '', 'GOOGLE_API_KEY': env_key}
+      ):
+        _ = gemini_api.GeminiAPI()
+    self.assertEqual(self.mock_list_models.call_count, 2)
+
+  def test_verify_models_raises_for_unavailable_model(self):
+    with self.assertRaisesRegex(ValueError, 'Model models/unknown not avail*'):
+      _ = gemini_api.GeminiAPI(
+          api_key='some_key', generate_model_name='models/unknown'
+      )
+
   def test_generate_and_count_tokens(self):
     """Verifies that repeated calls to the cached method behave as expected.
 
@@ -191,13 +339,13 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     with self.subTest('returns_correct_result_1'):
       self.assertEqual(res, 'a' * 10)
     expected_backend_counters = collections.Counter({
-        'generate_text': 1,
-        'generate_text_batches': 1,
+        'generate_texts': 1,
+        'generate_texts_batches': 1,
         'count_tokens': 1,
         'count_tokens_batches': 1,
     })
     with self.subTest('sends_correct_number_of_api_calls_1'):
-      self.assertCounterEqual(backend._counters, expected_backend_counters)
+      self.assertCounterEqual(backend.counters, expected_backend_counters)
     # One add and one miss for generate and count_tokens each.
     expected_cache_counters = Counter(add_new=2, get_miss=2)
     with self.subTest('cache_behaves_as_expected_1'):
@@ -216,7 +364,7 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     with self.subTest('returns_correct_result_2'):
       self.assertEqual(res, 'a' * 10)
     with self.subTest('sends_correct_number_of_api_calls_2'):
-      self.assertCounterEqual(backend._counters, expected_backend_counters)
+      self.assertCounterEqual(backend.counters, expected_backend_counters)
     expected_cache_counters['get_hit'] += 2  # Generate and count_tokens.
     with self.subTest('cache_behaves_as_expected_2'):
       self.assertCounterEqual(
@@ -235,13 +383,13 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
       self.assertEqual(res, 'a' * 10)
     # We only send generate call, not the count_tokens call.
     expected_backend_counters = collections.Counter({
-        'generate_text': 2,
-        'generate_text_batches': 2,
+        'generate_texts': 2,
+        'generate_texts_batches': 2,
         'count_tokens': 1,
         'count_tokens_batches': 1,
     })
     with self.subTest('sends_correct_number_of_api_calls_3'):
-      self.assertCounterEqual(backend._counters, expected_backend_counters)
+      self.assertCounterEqual(backend.counters, expected_backend_counters)
     expected_cache_counters['get_hit'] += 1  # Looked up count_tokens.
     expected_cache_counters['get_miss'] += 1  # Could not find generate.
     expected_cache_counters['add_new'] += 1  # Cached generate.
@@ -269,14 +417,14 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     with self.subTest('returns_correct_result'):
       self.assertEqual(res, 5 * ['a' * 10])
     expected_backend_counters = collections.Counter({
-        'generate_text': 5,
-        'generate_text_batches': 2,  # Two batches: 4 + 1.
+        'generate_texts': 5,
+        'generate_texts_batches': 2,  # Two batches: 4 + 1.
         'count_tokens': 1,  # Because all the prompts are the same.
         'count_tokens_batches': 1,
     })
     with self.subTest('sends_correct_number_of_api_calls'):
       self.assertCounterEqual(
-          backend._counters,
+          backend.counters,
           expected_backend_counters,
       )
     expected_cache_counters = Counter(
@@ -339,14 +487,14 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     with self.subTest('returns_correct_result'):
       self.assertEqual(res, 5 * ['a' * 10])
     expected_backend_counters = collections.Counter({
-        'generate_text': 5,
-        'generate_text_batches': 2,  # Two batches: 4 + 1.
+        'generate_texts': 5,
+        'generate_texts_batches': 2,  # Two batches: 4 + 1.
         'count_tokens': 5,
         'count_tokens_batches': 2,  # Two batches: 4 + 1.
     })
     with self.subTest('sends_correct_number_of_api_calls'):
       self.assertCounterEqual(
-          backend._counters,
+          backend.counters,
           expected_backend_counters,
       )
     expected_cache_counters = Counter(add_new=10, get_miss=10)
@@ -372,14 +520,14 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     with self.subTest('returns_correct_result'):
       self.assertEqual(res, 5 * ['a' * 10])
     expected_backend_counters = collections.Counter({
-        'generate_text': 1,
-        'generate_text_batches': 1,
+        'generate_texts': 1,
+        'generate_texts_batches': 1,
         'count_tokens': 1,
         'count_tokens_batches': 1,
     })
     with self.subTest('sends_correct_number_of_api_calls'):
       self.assertCounterEqual(
-          backend._counters,
+          backend.counters,
           expected_backend_counters,
       )
     expected_cache_counters = Counter(add_new=2, get_miss=2, get_hit=8)
@@ -419,6 +567,73 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
       ):
         _ = executing.run(exe)
 
+  def test_identical_concurrent_count_tokens_without_cache(self):
+    backend = gemini_api.GeminiAPI(
+        api_key='some_key', batch_size=_BATCH_SIZE, disable_caching=True
+    )
+    backend.register()
+    exe = executing.par_iter(
+        [llm.count_tokens(content='Something') for _ in range(5)]
+    )
+    res = executing.run(exe)
+    with self.subTest('returns_correct_result'):
+      self.assertEqual(res, 5 * [_MOCK_COUNT_TOKENS_RETURN])
+    with self.subTest('sends_one_api_call_per_batch'):
+      # Two batches: 4 + 1, the identical requests within a batch are sent
+      # only once.
+      self.assertEqual(self.num_count_tokens_api_calls, 2)
+
+  def test_successive_runs_share_async_client(self):
+    _ = _get_and_register_backend()
+    # Each call to executing.run uses a new event loop.
+    first = executing.run(llm.generate_text(prompt='Something'))
+    second = executing.run(llm.generate_text(prompt='Something else'))
+    count = executing.run(llm.count_tokens(content='Something'))
+    with self.subTest('returns_correct_results'):
+      self.assertEqual([first, second], ['a' * 10, 'a' * 10])
+      self.assertEqual(count, _MOCK_COUNT_TOKENS_RETURN)
+    with self.subTest('creates_a_single_client'):
+      self.assertEqual(self.num_async_clients, 1)
+
+  def test_single_flight_cancellation_unblocks_waiters(self):
+    backend = _get_and_register_backend()
+
+    async def call() -> int:
+      await asyncio.sleep(10)
+      return 1
+
+    async def wrapper():
+      first = asyncio.create_task(backend._single_flight('key', call))
+      await asyncio.sleep(0)
+      second = asyncio.create_task(backend._single_flight('key', call))
+      await asyncio.sleep(0)
+      first.cancel()
+      return await asyncio.wait_for(
+          asyncio.gather(first, second, return_exceptions=True), timeout=1
+      )
+
+    results = asyncio.run(wrapper())
+    with self.subTest('cancels_waiters'):
+      self.assertIsInstance(results[0], asyncio.CancelledError)
+      self.assertIsInstance(results[1], asyncio.CancelledError)
+    with self.subTest('forgets_cancelled_call'):
+      self.assertEmpty(backend._inflight)
+
+  def test_rate_limiting(self):
+    backend = gemini_api.GeminiAPI(
+        api_key='some_key', batch_size=_BATCH_SIZE, max_qps=2.0
+    )
+    backend.register()
+    start = time.perf_counter()
+    exe = executing.par_iter(
+        [llm.count_tokens(content=f'Something {i}') for i in range(6)]
+    )
+    _ = executing.run(exe)
+    end = time.perf_counter()
+    # The first 2 requests go through immediately (burst), the remaining 4
+    # at 2qps take ~2s.
+    self.assertBetween(end - start, 1.5, 3.0)
+
   def test_generate_texts(self):
     _ = _get_and_register_backend()
     prompt = 'Something'
@@ -426,6 +641,77 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     self.assertLen(results, 3)
     self.assertListEqual(list(results), ['a' * 10, 'a' * 10, 'a' * 10])
 
+  def test_approximate_count_tokens(self):
+    backend = _get_and_register_backend()
+    content = ChunkList([Chunk('abcdefg'), Chunk(b'some_bytes')])
+    approximate = asyncio.run(backend.count_tokens(content, approximate=True))
+    exact = executing.run(llm.count_tokens(content='abcdefg'))
+
+    with self.subTest('estimates_text_and_image_tokens'):
+      self.assertEqual(approximate, 3 + gemini_api._TOKENS_PER_IMAGE)
+
+    with self.subTest('builtin_returns_exact_count'):
+      self.assertEqual(exact, _MOCK_COUNT_TOKENS_RETURN)
+
+    with self.subTest('only_exact_count_calls_api'):
+      self.assertEqual(self.num_count_tokens_api_calls, 1)
+
+  def test_generate_text_raises_for_empty_response(self):
+    _ = _get_and_register_backend()
+    with self.assertRaisesRegex(ValueError, 'returned no answers'):
+      executing.run(llm.generate_texts(prompt='empty_response', samples=2))
+
+  def test_generate_text_with_chunk_list(self):
+    _ = _get_and_register_backend()
+    prompt = ChunkList([
+        Chunk('Describe this image'),
+        Chunk(b'some_bytes', content_type='image/jpeg'),
+    ])
+    result = executing.run(llm.generate_text(prompt=prompt))
+    self.assertEqual(result, 'a' * 10)
+
+  def test_embed(self):
+    async def mock_embed_content(
+        model: str, content: list[str]
+    ) -> dict[str, Any]:
+      del model
+      return {
+          'embedding': [[0.5, 1.5, float(len(text))] for text in content]
+      }
+
+    self.enter_context(
+        mock.patch.object(
+            generativeai,
+            'embed_content_async',
+            autospec=True,
+            side_effect=mock_embed_content,
+        )
+    )
+    backend = _get_and_register_backend()
+    result = executing.run(llm.embed(content='something'))
+    cached_result = executing.run(llm.embed(content='something'))
+    # Five distinct contents, i.e. two batches of size at most _BATCH_SIZE.
+    results = executing.run(
+        executing.par_iter([llm.embed(content='a' * i) for i in range(5)])
+    )
+
+    with self.subTest('returns_float32_array'):
+      self.assertEqual(result.dtype, np.float32)
+      np.testing.assert_array_equal(result, [0.5, 1.5, 9.0])
+
+    with self.subTest('returns_same_result_from_cache'):
+      np.testing.assert_array_equal(cached_result, result)
+
+    with self.subTest('scatters_batched_results_back_to_callers'):
+      for i, embedding in enumerate(results):
+        np.testing.assert_array_equal(embedding, [0.5, 1.5, float(i)])
+
+    with self.subTest('sends_one_api_call_per_batch'):
+      self.assertCounterEqual(
+          backend.counters,
+          collections.Counter({'embed': 6, 'embed_batches': 3}),
+      )
+
   def test_chat(self):
     backend = _get_and_register_backend()
     msg = Message(role=PredefinedRole.USER, content='Hello')
@@ -440,7 +726,29 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     })
 
     with self.subTest('sends_correct_number_of_api_calls'):
-      self.assertCounterEqual(backend._counters, expected_backend_counters)
+      self.assertCounterEqual(backend.counters, expected_backend_counters)
+
+  def test_multi_turn_chat_reuses_history_contents(self):
+    _ = _get_and_register_backend()
+    gemini_api._text_to_content.cache_clear()
+    messages = [
+        Message(role=PredefinedRole.USER, content='Hello'),
+        Message(role=PredefinedRole.MODEL, content='Hi'),
+        Message(role=PredefinedRole.USER, content='How are you?'),
+    ]
+    _ = executing.run(llm.chat(messages=messages))
+    messages += [
+        Message(role=PredefinedRole.MODEL, content='Fine'),
+        Message(role=PredefinedRole.USER, content='Good'),
+    ]
+    result = executing.run(llm.chat(messages=messages))
+
+    with self.subTest('returns_correct_result'):
+      self.assertEqual(result, 'a' * 10)
+
+    with self.subTest('reuses_contents_of_previous_turns'):
+      # The first three messages were already converted in the first turn.
+      self.assertEqual(gemini_api._text_to_content.cache_info().hits, 3)
 
   def test_truncation(self):
     _ = _get_and_register_backend()
@@ -451,6 +759,45 @@ class GeminiAPITest(parameterized.TestCase, core_test_utils.CounterAssertions):
     )
     self.assertEqual(result, ('a' * 6, {'text': 'a' * 10}))
 
+  def test_truncation_with_streaming(self):
+    backend = gemini_api.GeminiAPI(
+        api_key='some_key', batch_size=_BATCH_SIZE, enable_streaming=True
+    )
+    backend.register()
+    result = executing.run(
+        llm.generate_text(
+            prompt='something', include_details=True, max_tokens=2
+        )
+    )
+
+    with self.subTest('returns_truncated_result'):
+      self.assertEqual(result, ('abcabc', {'text': 'abcabc'}))
+
+    with self.subTest('stops_reading_the_stream_early'):
+      self.assertLess(self.num_streamed_chunks, 10)
+
+    with self.subTest('closes_the_stream'):
+      self.assertTrue(self.is_stream_closed)
+
+    with self.subTest('wraps_errors_raised_while_streaming'):
+      with self.assertRaisesRegex(
+          ValueError, 'GeminiAPI.generate_content raised err:\nFake stream'
+      ):
+        executing.run(
+            llm.generate_text(prompt='raise_in_stream', max_tokens=20)
+        )
+
+  def test_truncation_of_multiple_samples(self):
+    _ = _get_and_register_backend()
+    results = executing.run(
+        llm.generate_texts(
+            prompt='something', samples=2, include_details=True, max_tokens=2
+        )
+    )
+    self.assertListEqual(
+        list(results), [('a' * 6, {'text': 'a' * 10})] * 2
+    )
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -1112,9 +1112,14 @@ def batchable_function(
   def inner(
       function: Callable[_Args, _ReplyT | Awaitable[_ReplyT]]
   ) -> Callable[_Args, Awaitable[_ReplyT]]:
+    # Computed once here rather than on every call.
+    signature = inspect.signature(function)
+
     @functools.wraps(function)
     async def wrapped(*args: _Args.args, **kwargs: _Args.kwargs) -> _ReplyT:
-      arguments = utils.get_expanded_arguments(function, True, args, kwargs)
+      arguments = utils.get_expanded_arguments(
+          function, True, args, kwargs, signature
+      )
       replies = await implementation([arguments])
       return replies[0]
     return wrapped
@@ -1161,10 +1166,13 @@ def batchable_method(
   ) -> Callable[_Args, Awaitable[_ReplyT]]:
     if not utils.is_method(method):
       raise ValueError('batchable_method can decorate only methods.')
+    # Computed once here rather than on every call.
+    signature = inspect.signature(method)
+
     @functools.wraps(method)
     async def wrapped(self, *args, **kwargs):
       arguments = utils.get_expanded_arguments(
-          method, True, (self,) + args, kwargs
+          method, True, (self,) + args, kwargs, signature
       )
       assert 'self' in arguments
       del arguments['self']
@@ -1360,6 +1368,83 @@ def run_method_in_threadpool(
   return wrapper
 
 
+def run_method_with_asyncio(
+    method: Callable[..., Awaitable[_ReplyT]],
+    return_exceptions: bool = False,
+) -> Callable[[Any, ParametersBatch], Awaitable[Sequence[_ReplyT | None]]]:
+  """Decorator to run a coroutine method on a list of inputs concurrently.
+
+  This is the asyncio counterpart of `run_method_in_threadpool`: instead of
+  sending each request from a separate thread, all the requests of a batch are
+  awaited concurrently (with `asyncio.gather`) from the current event loop.
+  This is better suited for I/O-bound methods (e.g. calls to a remote API
+  exposing an async client).
+
+  Example:
+  ```
+  class C:
+    @run_method_with_asyncio
+    async def my_fn(self, s: str, i: int): str
+    ...
+
+  c = C()
+  results = await c.my_fn([{'s': 'some str', 'i', 0}, {'s': 'other str', 'i',
+  1}])
+  ```
+
+  Args:
+    method: The coroutine function to be decorated.
+    return_exceptions: If False, any exception will stop the processing and no
+      result will be returned. If True, exceptions produced by individual
+      requests will be used as their returned result, so that the processing
+      will not be interrupted.
+
+  Returns:
+    A coroutine method which takes a sequence of inputs (each input being a dict
+    of parameter values for the decorated method), awaits the decorated
+    method on each of these inputs concurrently, and returns all the results as
+    a sequence.
+
+  Raises:
+    ValueError if one of the calls to the underlying method fails.
+  """
+  if not inspect.iscoroutinefunction(method):
+    raise ValueError(
+        '@run_method_with_asyncio can only be used with coroutines (i.e.'
+        ' functions defined with async def).'
+    )
+
+  if return_exceptions:
+    method = utils.returning_raised_exception(method)
+
+  @functools.wraps(method)
+  async def wrapper(
+      self, requests: ParametersBatch
+  ) -> Sequence[_ReplyT | None]:
+    exceptions = []
+
+    async def executor(kwargs: Parameters) -> _ReplyT | None:
+      nonlocal exceptions
+      try:
+        return await method(self, *(), **kwargs)
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        exceptions.append(e)
+        return None
+
+    replies = await asyncio.gather(
+        *[executor(kwargs) for kwargs in requests]
+    )
+    if exceptions:
+      raise ValueError(
+          'One or more exceptions happened during running'
+          f' {method.__name__} with asyncio:\n'  # pylint: disable=attribute-error
+          + _render_exceptions(exceptions)
+      ) from exceptions[0]
+    return replies
+
+  return wrapper
+
+
 def batch_function_with_threadpool(
     batch_size: int | None = None,
     batching_function: _BatchingFunction[_RequestT] | None = None,
@@ -1522,6 +1607,96 @@ def batch_method_with_threadpool(
   return inner
 
 
+def batch_method_with_asyncio(
+    batch_size: int | utils.FromInstance[int] | None = None,
+    batching_function: (
+        _BatchingFunction[_RequestT]
+        | utils.FromInstance[_BatchingFunction[_RequestT]]
+        | None
+    ) = None,
+    wrapper: (
+        Callable[
+            [_BatchedMethod[_RequestT, _ReplyT | Exception]],
+            _BatchedMethod[_RequestT, _ReplyT | Exception],
+        ] | None
+    ) = None,
+    debug: bool = False,
+) -> Callable[
+    [Callable[..., Awaitable[_ReplyT]]],  # TODO: Replace with _Args.
+    Callable[..., Awaitable[_ReplyT]],  # TODO: Replace with _Args.
+]:
+  """Convenience decorator to create a batched coroutine method.
+
+  This is the same as `batch_method_with_threadpool` except that the decorated
+  method is a coroutine and the requests of a batch are awaited concurrently
+  from a single event loop (see `run_method_with_asyncio`) rather than being
+  sent from separate threads.
+
+  Writing the following code
+  ```
+  @add_batching
+  class C:
+    @batch_method_with_asyncio(batch_size=3, wrapper=my_wrapper)
+    async def my_fn(self, s: str, i: int): str
+      # Actual implementation of the method on one instance.
+      ...
+  ```
+  is equivalent to writing the following longer code
+  ```
+  @add_batching
+  class C:
+    @batchable_method(implementation=utils.FromInstance('my_fn_batch')
+    def my_fn(self, s: str, i: int): str
+      pass
+
+    @batch_method(batch_size=3)
+    @my_wrapper
+    @run_method_with_asyncio
+    async def my_fn_batch(self, s: str, i: int): str
+      # Actual implementation of the method on one instance.
+      ...
+  ```
+
+  Args:
+    batch_size: If provided, batching will be done simply by checking the size.
+    batching_function: If provided, this is used to determine whether new
+      requests can be added to an existing batch. See BatchQueue for more
+      information.
+    wrapper: If not None, a wrapper for the batched method (e.g. to perform
+      some batch-level logging).
+    debug: If True, the calls to the function will be saved for debugging.
+
+  Returns:
+    A wrapper that makes the method into a batched coroutine.
+  """
+
+  def inner(
+      method: Callable[..., Awaitable[_ReplyT]]
+  ) -> Callable[..., Awaitable[_ReplyT]]:
+    asyncio_method = run_method_with_asyncio(method, return_exceptions=True)
+    if wrapper is not None:
+      signature = inspect.signature(asyncio_method)
+      asyncio_method = wrapper(asyncio_method)
+      other_signature = inspect.signature(asyncio_method)
+      if signature != other_signature:
+        raise ValueError(
+            f'The wrapper {wrapper} changed the signature from {signature} to'
+            f' {other_signature}.'
+        )
+    return utils.raising_returned_exception(
+        batchable_method(
+            implementation=batch_method(
+                batch_size=batch_size,
+                batching_function=batching_function,
+                debug=debug,
+            )(asyncio_method),
+            pass_self=True,
+        )(asyncio_method)
+    )
+
+  return inner
+
+
 def add_logging(method):
   """Wraps a batch method to add logging and counting calls.
 
@@ -1540,14 +1715,17 @@ def add_logging(method):
   )
   ```
 
+  The batch method can be either a regular method (e.g. when used with
+  `batch_method_with_threadpool`) or a coroutine method (e.g. when used with
+  `batch_method_with_asyncio`).
+
   Args:
     method: The method to be decorated.
 
   Returns:
     A decorated method that records calls into the self._counters object.
   """
-  @functools.wraps(method)
-  def wrapped_method(self, requests: Sequence[Any]) -> Sequence[Any]:
+  def log_batch(self, requests: Sequence[Any]) -> None:
     logging.info(
         'Executing a batch of %d %s requests', len(requests), method.__name__
     )
@@ -1555,8 +1733,22 @@ def add_logging(method):
     # pylint: disable=protected-access
     self._counters[f'{method.__name__}_batches'] += 1
     # pylint: enable=protected-access
+
+  @functools.wraps(method)
+  def wrapped_method(self, requests: Sequence[Any]) -> Sequence[Any]:
+    log_batch(self, requests)
     result = method(self, requests)
     logging.info('Received results for %s requests', method.__name__)
     return result
 
-  return wrapped_method
+  @functools.wraps(method)
+  async def awrapped_method(self, requests: Sequence[Any]) -> Sequence[Any]:
+    log_batch(self, requests)
+    result = await method(self, requests)
+    logging.info('Received results for %s requests', method.__name__)
+    return result
+
+  if inspect.iscoroutinefunction(method):
+    return awrapped_method
+  else:
+    return wrapped_method
@@ -1001,6 +1001,82 @@ class BatchingTest(parameterized.TestCase):
       self.assertEqual(c_instance.batches, 4)
       self.assertEqual(c_instance.calls, 10)
 
+  def test_run_method_with_asyncio(self):
+    class C:
+      @batching.run_method_with_asyncio
+      async def process(self, request):
+        await asyncio.sleep(0)
+        return request
+
+      @batching.run_method_with_asyncio
+      async def process_with_error(self, request):
+        if request == 1 or request == 3:
+          raise KeyError(str(request))
+        return request
+
+    results = asyncio.run(C().process([{'request': i} for i in range(10)]))
+
+    self.assertListEqual(
+        list(range(10)), list(results), pprint.pformat(results)
+    )
+
+    with self.assertRaisesRegex(ValueError, 'KeyError'):
+      _ = asyncio.run(
+          C().process_with_error([{'request': i} for i in range(4)])
+      )
+
+  def test_batching_method_with_asyncio_single_decorator(self):
+    calls = []
+
+    def wrapper(method):
+      @functools.wraps(method)
+      async def wrapped_method(
+          self, requests: Sequence[Any]
+      ) -> Sequence[Any]:
+        self.batches += 1
+        return await method(self, requests)
+
+      return wrapped_method
+
+    @batching.add_batching
+    class C:
+      def __init__(self):
+        self.batches = 0
+        self.calls = 0
+
+      @batching.batch_method_with_asyncio(batch_size=3, wrapper=wrapper)
+      async def process(self, request):
+        nonlocal calls
+        t = time.time()
+        calls.append((request, int(t)))
+        self.calls += 1
+        await asyncio.sleep(1)
+        return request
+
+    c_instance = C()
+    async def run_plan():
+      nonlocal c_instance
+      coroutines = [c_instance.process(i) for i in range(10)]
+      return await asyncio.gather(*coroutines)
+
+    run_results = batching.run(run_plan())
+
+    with self.subTest('should_produce_the_right_results'):
+      self.assertListEqual(
+          run_results, [i for i in range(10)], pprint.pformat(run_results)
+      )
+
+    with self.subTest('should_produce_4_batches_in_less_than_5_seconds'):
+      # Requests within a batch are awaited concurrently, so the timestamps of
+      # all the requests are spread over 3 to 5 seconds max.
+      times = [c[1] for c in calls]
+      span = max(times) - min(times)
+      self.assertBetween(span, 3, 5, msg=pprint.pformat(times))
+
+    with self.subTest('should_produce_the_right_counters'):
+      self.assertEqual(c_instance.batches, 4)
+      self.assertEqual(c_instance.calls, 10)
+
   def test_fills_batches_in_par_of_par(self):
     @batching.add_batching
     class BatchClass:
@@ -1469,6 +1545,97 @@ class BatchingTest(parameterized.TestCase):
               enable_batching=enable_batching,
           )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'no_error_batching_enabled',
+          'inputs': [1, 2, 3],
+          'enable_batching': True,
+          'expected_results': [1, 2, 3],
+          'expected_error_message_if_not_caught': None,
+      },
+      {
+          'testcase_name': 'single_error_batching_enabled',
+          'inputs': [1, ValueError('error2'), 3],
+          'enable_batching': True,
+          'expected_results': [1, 'error2', 3],
+          'expected_error_message_if_not_caught': 'error2',
+      },
+      {
+          'testcase_name': 'no_error_batching_disabled',
+          'inputs': [1, 2, 3],
+          'enable_batching': False,
+          'expected_results': [1, 2, 3],
+          'expected_error_message_if_not_caught': None,
+      },
+      {
+          'testcase_name': 'single_error_batching_disabled',
+          'inputs': [1, ValueError('error2'), 3],
+          'enable_batching': False,
+          'expected_results': [1, 'error2', 3],
+          'expected_error_message_if_not_caught': 'error2',
+      },
+  )
+  def test_exception_handling_batch_method_with_asyncio(
+      self,
+      inputs,
+      enable_batching,
+      expected_results,
+      expected_error_message_if_not_caught,
+  ):
+    @batching.add_batching
+    class C:
+
+      @executing.make_executable
+      @batching.batch_method_with_asyncio(batch_size=2)
+      async def process(self, request: int | Exception) -> int:
+        await asyncio.sleep(0)
+        if isinstance(request, Exception):
+          raise request
+        else:
+          return request
+
+      @executing.make_executable
+      async def process_with_error_handling(
+          self, x: int | Exception
+      ) -> int | str:
+        try:
+          return await self.process(x)
+        except Exception as e:  # pylint: disable=broad-except
+          return str(e)
+
+    async def process_all_without_error_handling(
+        inputs: Sequence[int | Exception],
+    ) -> Sequence[int]:
+      c = C()
+      executables = [c.process(x) for x in inputs]
+      return await executing.parallel(*executables)
+
+    async def process_all_with_error_handling(
+        inputs: Sequence[int | Exception],
+    ) -> Sequence[int | str]:
+      c = C()
+      executables = [c.process_with_error_handling(x) for x in inputs]
+      return await executing.parallel(*executables)
+
+    results = batching.run(
+        process_all_with_error_handling(inputs), enable_batching=enable_batching
+    )
+    self.assertSequenceEqual(expected_results, results, pprint.pformat(results))
+
+    if expected_error_message_if_not_caught is not None:
+      with self.subTest('raises_informative_error_if_not_caught'):
+        # Here we verify that if the caller does not implement any error
+        # handling, the original error gets raised (the same as it would if no
+        # batching were applied), rather than getting masked by an error like
+        # "ValueError: Attempting to finish a non-empty queue".
+        with self.assertRaisesRegex(
+            ValueError, expected_error_message_if_not_caught
+        ):
+          batching.run(
+              process_all_without_error_handling(inputs),
+              enable_batching=enable_batching,
+          )
+
 
 if __name__ == '__main__':
   absltest.main()
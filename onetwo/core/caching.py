@@ -18,7 +18,8 @@ from __future__ import annotations
 import abc
 import asyncio
 import collections
-from collections.abc import ByteString, Callable, Coroutine, Mapping, Sequence
+from collections.abc import ByteString, Callable, Collection, Coroutine, Mapping
+from collections.abc import Sequence
 import contextvars
 import copy
 import dataclasses
@@ -27,7 +28,9 @@ import inspect
 import json
 import logging
 import os
+import sqlite3
 import threading
+import time
 import traceback
 from typing import Any, Final, Generic, ParamSpec, TypeVar
 
@@ -117,10 +120,9 @@ def nested_defaultdict_decoder(
     arg: collections.defaultdict
 ) -> collections.defaultdict:
   """Decodes a defaultdict of int to defaultdict of str to int."""
-  decoded = dict(arg)
   return collections.defaultdict(
       functools.partial(collections.defaultdict, int),
-      {k: collections.defaultdict(int, v) for k, v in decoded.items()},
+      {k: collections.defaultdict(int, v) for k, v in arg.items()},
   )
 
 
@@ -128,11 +130,7 @@ def defaultdict_decoder(
     arg: collections.defaultdict
 ) -> collections.defaultdict:
   """Decodes a defaultdict of int to int."""
-  decoded = dict(arg)
-  return collections.defaultdict(
-      int,
-      {k: v for k, v in decoded.items()},
-  )
+  return collections.defaultdict(int, arg)
 
 
 def nested_defaultdict_initializer(
@@ -267,34 +265,60 @@ class FileCacheEnabled(Generic[CachedType], CacheEnabled[CachedType]):
 def _create_cache_key(
     name: str,
     arguments: Mapping[str, Any],
-    hashed: Sequence[str] | None = None,
+    hashed: Collection[str] | None = None,
+    hash_fn: Callable[[Any], str] = utils.get_str_hash,
 ) -> str:
   """Creates a cache key for arguments to a function.
 
   Args:
     name: Name of the function being called (i.e. destination).
     arguments: Arguments that the function has been called with.
-    hashed: Sequence of arguments that should be hashed because they tend to be
-      too big to be part of the key.
+    hashed: Collection of arguments that should be hashed because they tend to
+      be too big to be part of the key (preferably a set, since membership is
+      checked for every argument).
+    hash_fn: Function used to hash the arguments listed in `hashed`.
 
   Returns:
     Key to lookup in the cache.
   """
-
-  def maybe_hash(name: str, value: Any) -> Any:
-    if hashed is not None and name in hashed:
-      return utils.get_str_hash(value)
-    return value
-
-  arg_value_by_name = {
-      name: maybe_hash(name, value) for name, value in arguments.items()
-  }
+  if hashed:
+    arg_value_by_name = {
+        name: hash_fn(value) if name in hashed else value
+        for name, value in arguments.items()
+    }
+  else:
+    arg_value_by_name = dict(arguments)
   # Add function name to the dictionary.
   arg_value_by_name[constants.CACHING_FUNCTION_NAME_KEY] = name
+  if all(
+      type(value) in _MEMOIZABLE_KEY_VALUE_TYPES
+      for value in arg_value_by_name.values()
+  ):
+    # The type is part of the memoization key since e.g. `1 == True`.
+    return _serialize_cache_key(tuple(
+        (name, type(value), value)
+        for name, value in sorted(arg_value_by_name.items())
+    ))
   # Serialize it.
   return json.dumps(arg_value_by_name, sort_keys=True, default=repr)
 
 
+# Types of argument values for which the serialized cache key is memoized.
+# Floats are excluded since e.g. `0.0 == -0.0` while their serializations
+# differ.
+_MEMOIZABLE_KEY_VALUE_TYPES: Final[frozenset[type[Any]]] = frozenset(
+    {str, int, bool, type(None)}
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _serialize_cache_key(
+    items: tuple[tuple[str, type[Any], Any], ...],
+) -> str:
+  """Returns the JSON serialization of sorted (name, type, value) items."""
+  return json.dumps({name: value for name, _, value in items})
+
+
 @dataclasses.dataclass
 class CacheKeyMaker(Generic[CachedType]):
   """Class that converts inputs of a method into cache key.
@@ -306,22 +330,40 @@ class CacheKeyMaker(Generic[CachedType]):
       complex data type like this, to avoid the cache key to be huge.
     dropped: A Sequence of strings corresponding to the names of parameters that
       should not be used as part of the cache key.
+    hash_fn: Function used to hash the parameters listed in `hashed`. Defaults
+      to `utils.get_str_hash`. Changing it changes the keys of already cached
+      values.
     is_initialized: Whether method initialize was already called.
     _method: The method whose inputs have to be converted (set automatically by
       the cache_method decorator).
     _name: The name of the method (for the cache -- set automatically by the
       cache_method decorator).
+    _signature: The signature of the method, computed once at decoration time
+      since it is used to expand the arguments of every call.
+    _hashed_names: Set of the names in `hashed` (set at decoration time).
+    _dropped_names: Set of the names in `dropped`, including `self` (set at
+      decoration time).
   """
 
   # Constructor parameters.
   hashed: Sequence[str] | None = None
   dropped: Sequence[str] | None = None
+  hash_fn: Callable[[Any], str] = utils.get_str_hash
   # Parameters set via the initialize method (will be set by the cache_method
   # decorator).
   _method: (
       Callable[..., CachedType] | None
   ) = dataclasses.field(default=None, init=False)
   _name: str | None = dataclasses.field(default=None, init=False)
+  _signature: inspect.Signature | None = dataclasses.field(
+      default=None, init=False
+  )
+  _hashed_names: frozenset[str] = dataclasses.field(
+      default=frozenset(), init=False
+  )
+  _dropped_names: frozenset[str] = dataclasses.field(
+      default=frozenset(), init=False
+  )
 
   @property
   def is_initialized(self) -> bool:
@@ -346,6 +388,9 @@ class CacheKeyMaker(Generic[CachedType]):
     """
     self._method = method
     self._name = name
+    self._signature = inspect.signature(method)
+    self._hashed_names = frozenset(self.hashed or ())
+    self._dropped_names = frozenset(self.dropped or ()) | {'self'}
 
   def create_key(
       self,
@@ -365,15 +410,17 @@ class CacheKeyMaker(Generic[CachedType]):
       Cache key to lookup.
     """
     arguments = utils.get_expanded_arguments(
-        self._method, True, (obj_with_cache,) + args, kwargs
+        self._method,
+        True,
+        (obj_with_cache,) + args,
+        kwargs,
+        signature=self._signature,
     )
-    arguments.pop('self', None)
-    if self.dropped is not None:
-      for name in self.dropped:
-        # Remove arguments with that name from the main arguments.
-        arguments.pop(name, None)
+    for name in self._dropped_names:
+      # Remove arguments with that name from the main arguments.
+      arguments.pop(name, None)
     key = _create_cache_key(
-        self._name, arguments, self.hashed
+        self._name, arguments, self._hashed_names, self.hash_fn
     )
     return key
 
@@ -559,7 +606,7 @@ def cache_method(
         maker: CacheKeyMaker,
         args: Any,
         kwargs: Any,
-    ) -> tuple[CachedType, tuple[str, str | None]]:
+    ) -> tuple[CachedType | None, tuple[str | None, str | None]]:
       """Performs the lookup in the cache.
 
       Args:
@@ -572,6 +619,8 @@ def cache_method(
       Returns:
         The value found in cache if it exists or None, along with the cache key
         computed from the input arguments of the method and the sampling key.
+        If caching is disabled for obj_with_cache, the key is not computed and
+        None is returned in its place.
 
       Raises:
         ValueError if the object on which the method is called does not inherit
@@ -582,15 +631,15 @@ def cache_method(
         sampling_key = context_sampling_key.get()
       else:
         sampling_key = None
-      key = maker.create_key(obj_with_cache, args, kwargs)
       cache_handler = _get_cache_handler(obj_with_cache)
       if obj_with_cache.disable_caching:
-        value = None
-      else:
-        value = await cache_handler.get_cached_value(
-            key=key,
-            sampling_key=sampling_key,
-        )
+        # The key would be used neither for lookup nor for storage.
+        return None, (None, sampling_key)
+      key = maker.create_key(obj_with_cache, args, kwargs)
+      value = await cache_handler.get_cached_value(
+          key=key,
+          sampling_key=sampling_key,
+      )
       return value, (key, sampling_key)
 
     def store(
@@ -650,12 +699,19 @@ def cache_method(
 
       # Here "self" is the object of class CacheEnabled. We are decorating one
       # of its methods.
-      value, (key, sampling_key) = await lookup(self, maker, args, kwargs)
+      value, call = await lookup(self, maker, args, kwargs)
       if value is not None:
         return value
-      # Actually process the call. But first indicate that we are processing it.
-      if hasattr(self._cache_handler, '_calls_in_progress'):
-        self._cache_handler._calls_in_progress |= {(key, sampling_key)}
+      key, sampling_key = call
+      # Actually process the call. But first indicate that we are processing it
+      # (unless caching is disabled, in which case nothing will be stored).
+      calls_in_progress = None
+      if not self.disable_caching:
+        calls_in_progress = getattr(
+            self._cache_handler, '_calls_in_progress', None
+        )
+      if calls_in_progress is not None:
+        calls_in_progress.add(call)
       # Call/await depending on whether decorating a sync or async method.
       try:
         if inspect.iscoroutinefunction(method):
@@ -664,33 +720,37 @@ def cache_method(
         else:
           value = method(*((self,) + args), **kwargs)
       except Exception as err:  # pylint: disable=broad-except
-        if hasattr(self._cache_handler, '_calls_in_progress'):
+        if calls_in_progress is not None:
           # We failed to process the call. Unblock other coroutines waiting for
           # the value.
-          self._cache_handler._calls_in_progress -= {(key, sampling_key)}
+          calls_in_progress.discard(call)
         raise ValueError(
             f'Error raised while executing method {method}:\n{err}\n'
         ) from err
-      # We may need to resolve cache_extra_replies's value at runtime.
-      do_cache_extra = utils.RuntimeParameter[bool](
-          cache_extra_replies, self
-      ).value()
-      if do_cache_extra:
-        # Method returns a Sequence of CachedType elements. Handle this case.
-        logging.info('Caching extra replies for method %s.', method.__name__)
-        value = return_first_and_cache_remaining(
-            values=value,
-            disable_caching=self.disable_caching,
-            cache_value_callback=functools.partial(
-                self._cache_handler.cache_value,  # pytype: disable=attribute-error
-                key,
-                None,  # No sampling_key set.
-            )
-        )
-      result = store(self, value, key, sampling_key)
-      # Finally indicate that we have processed the call and cached the value.
-      if hasattr(self._cache_handler, '_calls_in_progress'):
-        self._cache_handler._calls_in_progress -= {(key, sampling_key)}
+      try:
+        # We may need to resolve cache_extra_replies's value at runtime.
+        do_cache_extra = utils.RuntimeParameter[bool](
+            cache_extra_replies, self
+        ).value()
+        if do_cache_extra:
+          # Method returns a Sequence of CachedType elements. Handle this case.
+          logging.info('Caching extra replies for method %s.', method.__name__)
+          value = return_first_and_cache_remaining(
+              values=value,
+              disable_caching=self.disable_caching,
+              cache_value_callback=functools.partial(
+                  self._cache_handler.cache_value,  # pytype: disable=attribute-error
+                  key,
+                  None,  # No sampling_key set.
+              )
+          )
+        result = store(self, value, key, sampling_key)
+      finally:
+        # Finally indicate that we have processed the call and cached the value
+        # (or failed to, in which case the other coroutines waiting for it can
+        # process it themselves).
+        if calls_in_progress is not None:
+          calls_in_progress.discard(call)
 
       # pylint: enable=protected-access
       return result
@@ -758,6 +818,8 @@ class _CacheData(
   """Cache data.
 
   Attributes:
+    hash_algo: Algorithm with which the cache keys were hashed (see
+      utils.HASH_ALGO).
     counters: Counts of cache hits and misses, etc.
     values_by_key: Mapping of (hashed) cache keys to the existing values.
     num_used_values_by_key: Keeps track of how many of the existing values for
@@ -768,6 +830,9 @@ class _CacheData(
   """
   # Note: The order of the attributes here determines the order in which they
   # appear in the JSON file. Smaller attributes should go at the top.
+  # Cache files written before this attribute was introduced used sha224 (new
+  # caches are created with utils.HASH_ALGO, see SimpleFunctionCache).
+  hash_algo: str = 'sha224'
   counters: collections.Counter[str] = dataclasses.field(
       default_factory=collections.Counter,
       metadata=dataclasses_json.config(decoder=collections.Counter),
@@ -818,8 +883,8 @@ class _CacheData(
     Returns:
       A new cache object with contents stored in the cache file.
     """
-    if cached_value_decoder is None:
-      cached_value_decoder = lambda x: x
+    # Without decoder, the values are used as read from the file.
+    is_identity_decoder = cached_value_decoder is None
 
     with open(cache_file_path) as f:
       file_contents = f.read()
@@ -829,34 +894,55 @@ class _CacheData(
           infer_missing=True,
       )
       # pylint: disable=protected-access
-      for key_hash, cached_values in cache.values_by_key.items():
-        # When reading from json, the values objects are created as dict or
-        # other basic types. We convert them to the appropriate object using
-        # the provided decoder.
-        # Note that the encoding is done simply by calling `to_json` on the
-        # cache (which corresponds to `to_json` method of `DataClassJsonMixin`
-        # in `third_party/py/dataclasses_json/api.py`) so the decoder has to be
-        # able to read whatever calling `from_json(to_json())` produces.
-        cache.values_by_key[key_hash] = [
-            cached_value_decoder(cached_value) for cached_value in cached_values
-        ]
-
-        if restore_mapping:
-          logging.info('Restored sampling_key mapping from file.')
-        else:
-          logging.info('Create new sampling_key mapping.')
-          cache.num_used_values_by_key = collections.defaultdict(int)
-          cache.sample_id_by_sampling_key_by_key = (
-              nested_defaultdict_initializer()
-          )
+      if not is_identity_decoder:
+        for cached_values in cache.values_by_key.values():
+          # When reading from json, the values objects are created as dict or
+          # other basic types. We convert them to the appropriate object using
+          # the provided decoder (in place, the lists are already ours).
+          # Note that the encoding is done simply by calling `to_json` on the
+          # cache (which corresponds to `to_json` method of `DataClassJsonMixin`
+          # in `third_party/py/dataclasses_json/api.py`) so the decoder has to
+          # be able to read whatever calling `from_json(to_json())` produces.
+          cached_values[:] = map(cached_value_decoder, cached_values)
+
+      # This applies to the whole cache, so it is done once rather than for
+      # every key.
+      if restore_mapping:
+        logging.info('Restored sampling_key mapping from file.')
+      else:
+        logging.info('Create new sampling_key mapping.')
+        cache.num_used_values_by_key = collections.defaultdict(int)
+        cache.sample_id_by_sampling_key_by_key = (
+            nested_defaultdict_initializer()
+        )
       # pylint: enable=protected-access
     except Exception as error:  # pylint: disable=broad-except
       traceback.print_exc()
       raise RuntimeError(
           'Error parsing cache file %s.' % cache_file_path
       ) from error
+    cache.check_hash_algo(cache_file_path)
     return cache
 
+  def check_hash_algo(self, cache_file_path: str) -> None:
+    """Raises an error if the keys were not hashed with utils.HASH_ALGO.
+
+    Args:
+      cache_file_path: Path of the file the cache data was read from (used in
+        the error message).
+
+    Raises:
+      ValueError: If the keys were hashed with another algorithm, in which case
+        none of the cached values would be found.
+    """
+    if self.hash_algo != utils.HASH_ALGO:
+      raise ValueError(
+          f'The keys of cache file {cache_file_path} were hashed with'
+          f' {self.hash_algo}, but they are now hashed with {utils.HASH_ALGO}'
+          ' so none of its values would be found. Remove the file (or use'
+          ' another one) to start a new cache.'
+      )
+
   def cache_value(
       self,
       key: str,
@@ -884,31 +970,30 @@ class _CacheData(
     # implemented in the cache_method decorators by setting
     # cache_extra_replies=True. Each extra sample is cached explicitly using
     # the cache_value method with sampling_key=None.
-    if key in self.values_by_key:
-      existing_values = self.values_by_key[key]
+    existing_values = self.values_by_key.get(key)
+    if existing_values is not None:
       # We check whether we have an entry for the sampling_key.
-      if key in self.sample_id_by_sampling_key_by_key:
-        if sampling_key in self.sample_id_by_sampling_key_by_key[key]:
-          sample_id = self.sample_id_by_sampling_key_by_key[key][sampling_key]
-          # We found an entry, we assume it points to a valid entry in the list.
-          assert sample_id < len(existing_values)
-          # We replace this entry.
-          existing_value = existing_values[sample_id]
-          if value == existing_value:
-            logging.info('No result added for key %s', key_for_logging)
-            self.counters['add_redundant'] += 1
-          else:
-            # We have a match for both cache and sampling keys, but the already
-            # stored value is different from the one we are trying to store.
-            # This branch can not be reached if `cache_value` is called via
-            # `cache_method` decorator. It can only be reached when called
-            # explicitly.
-            self.counters['add_overwrote'] += 1
-            existing_values[sample_id] = value
-            logging.info('Overwriting cached value for key %s', key_for_logging)
-            logging.info('Old value: %s', repr(existing_value))
-            logging.info('New value: %s', repr(value))
-          return
+      sample_id = self._get_sample_id(key, sampling_key)
+      if sample_id is not None:
+        # We found an entry, we assume it points to a valid entry in the list.
+        assert sample_id < len(existing_values)
+        # We replace this entry.
+        existing_value = existing_values[sample_id]
+        if value == existing_value:
+          logging.info('No result added for key %s', key_for_logging)
+          self.counters['add_redundant'] += 1
+        else:
+          # We have a match for both cache and sampling keys, but the already
+          # stored value is different from the one we are trying to store.
+          # This branch can not be reached if `cache_value` is called via
+          # `cache_method` decorator. It can only be reached when called
+          # explicitly.
+          self.counters['add_overwrote'] += 1
+          existing_values[sample_id] = value
+          logging.info('Overwriting cached value for key %s', key_for_logging)
+          logging.info('Old value: %s', repr(existing_value))
+          logging.info('New value: %s', repr(value))
+        return
 
       # The cache key is not new but the sampling_key is. This can happen for
       # two reasons: (a) sampling_key is None or (b) sampling_key is not None
@@ -941,6 +1026,21 @@ class _CacheData(
         # sampling key.
         self.num_used_values_by_key[key] = 1
 
+  def _get_sample_id(self, key: str, sampling_key: str | None) -> int | None:
+    """Returns the sample_id mapped from the sampling_key, if any.
+
+    Contrary to indexing, this does not create entries in the (default dict)
+    mapping for keys that are not there.
+
+    Args:
+      key: The cache key.
+      sampling_key: The sampling key.
+    """
+    sample_id_by_sampling_key = self.sample_id_by_sampling_key_by_key.get(key)
+    if sample_id_by_sampling_key is None:
+      return None
+    return sample_id_by_sampling_key.get(sampling_key)
+
   def key_exists(self, key: str) -> bool:
     """Returns whether the given key exists in the cache."""
     return key in self.values_by_key
@@ -959,28 +1059,23 @@ class _CacheData(
     Returns:
       The value found in the cache if any or None otherwise.
     """
-    if key in self.values_by_key:
+    existing_values = self.values_by_key.get(key)
+    if existing_values is not None:
       # The key is in the cache, we check that we have an entry for the
       # sampling_key.
-      existing_values = self.values_by_key[key]
-      sample_id = 0
-      found = False
       if sampling_key is None:
         # Deterministic method is cached. Grab the first reply.
         sample_id = 0
-        found = True
-      if key in self.sample_id_by_sampling_key_by_key:
-        if (sampling_key in self.sample_id_by_sampling_key_by_key[key]):
-          sample_id = self.sample_id_by_sampling_key_by_key[key][sampling_key]
-          found = True
-      if not found:
+      else:
+        sample_id = self._get_sample_id(key, sampling_key)
+      if sample_id is None:
         # Do we have unused elements in the cache that we could associate with
         # this sampling key?
         # We check how many samples have already been mapped.
-        if self.num_used_values_by_key[key] < len(existing_values):
+        sample_id = self.num_used_values_by_key[key]
+        if sample_id < len(existing_values):
           # We map a new one.
-          sample_id = self.num_used_values_by_key[key]
-          self.num_used_values_by_key[key] += 1
+          self.num_used_values_by_key[key] = sample_id + 1
           self.sample_id_by_sampling_key_by_key[key][
               sampling_key
           ] = sample_id
@@ -1033,7 +1128,7 @@ class SimpleFunctionCache(
       default=None,
   )
   _cache_data: _CacheData[CachedType] = dataclasses.field(
-      default_factory=_CacheData
+      default_factory=lambda: _CacheData(hash_algo=utils.HASH_ALGO)
   )
   _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
   _calls_in_progress: set[tuple[str, str | None]] = dataclasses.field(
@@ -1064,9 +1159,19 @@ class SimpleFunctionCache(
     # A hash of the key is used whenever we need to map from the key.
     key_hash = utils.get_str_hash(key)
     with self._lock:
-      self._cache_data.cache_value(
-          key_hash, sampling_key, value, key_for_logging
-      )
+      self._insert(key_hash, sampling_key, value, key_for_logging)
+
+  def _insert(
+      self,
+      key_hash: str,
+      sampling_key: str | None,
+      value: CachedType,
+      key_for_logging: str,
+  ) -> None:
+    """Stores the value in the cache data (called while holding the lock)."""
+    self._cache_data.cache_value(
+        key_hash, sampling_key, value, key_for_logging
+    )
 
   async def get_cached_value(
       self,
@@ -1137,11 +1242,200 @@ class SimpleFunctionCache(
       raise FileExistsError(f'File {self.cache_filename} already exists.')
     # Create the directory if it doesn't exist yet
     os.makedirs(os.path.dirname(self.cache_filename), exist_ok=True)
-    with open(self.cache_filename, 'w') as f:
-      logging.info('Writing cache to file: %s', self.cache_filename)
+    # The whole cache is serialized in one go while holding the lock, so that
+    # values cached concurrently do not modify it in the middle of the
+    # serialization. The file is then written outside of the lock.
+    with self._lock:
       # The following call corresponds to `to_json` method of
       # `DataClassJsonMixin` in `third_party/py/dataclasses_json/api.py`. This
       # method in particular applies all the custom encoder transofrmations to
       # the individual fields provided via `metadata`.
-      f.write(self._cache_data.to_json())
+      contents = self._cache_data.to_json()
+    with open(self.cache_filename, 'w') as f:
+      logging.info('Writing cache to file: %s', self.cache_filename)
+      f.write(contents)
+
+
+def _encode_cached_value(value: Any) -> str:
+  """Returns the JSON encoding of a value, as stored in the cache files."""
+  # Going through the values_by_key field applies the same encoders (the one of
+  # the field, and the ones of dataclasses_json for e.g. Enum or datetime
+  # values) as _CacheData.to_json.
+  values = _CacheData(values_by_key={'': [value]}).to_dict(encode_json=True)
+  return json.dumps(values['values_by_key'][''][0])
+
+
+@dataclasses.dataclass
+class SqliteFunctionCache(
+    Generic[CachedType],
+    SimpleFunctionCache[CachedType],
+):
+  """SimpleFunctionCache persisted incrementally in an SQLite database.
+
+  Cached values are written to the database as soon as they are inserted (one
+  row per sample), so that long-running processes do not need to rewrite the
+  whole cache on every save. Lookups are still served from memory. Calling
+  `save` only persists the counters and the sampling_key mapping, which are
+  small in comparison with the values.
+
+  Cached values are stored as JSON (with the same encoding as the one used by
+  SimpleFunctionCache), hence `cached_value_decoder` has the same meaning as in
+  the parent class.
+
+  The connection to the database is closed with `close`, or when exiting the
+  cache used as a context manager:
+  ```
+  with SqliteFunctionCache(cache_filename='cache.sqlite') as cache:
+    cache.load()
+    ...
+  ```
+
+  Attributes:
+    cache_filename: Full path to the SQLite database file (inherited from
+      SimpleFunctionCache).
+    cached_value_decoder: See SimpleFunctionCache.
+  """
+
+  _connection: sqlite3.Connection | None = dataclasses.field(
+      default=None, init=False
+  )
+  # Whether the metadata stored in the database (if any) was read or written by
+  # this cache, see `save`.
+  _owns_metadata: bool = dataclasses.field(default=False, init=False)
+
+  def __enter__(self) -> SqliteFunctionCache[CachedType]:
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def close(self) -> None:
+    """Closes the connection to the database (reopened if the cache is used)."""
+    with self._lock:
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
+
+  def _get_connection(self) -> sqlite3.Connection:
+    """Returns the connection to the database, opening it if needed."""
+    if self._connection is None:
+      if not self.cache_filename:
+        raise ValueError(
+            'Cache filename must be provided when storing on disk.'
+        )
+      directory = os.path.dirname(self.cache_filename)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      # We run in autocommit mode: each insertion is a single-row upsert and
+      # with WAL journaling those are cheap.
+      connection = sqlite3.connect(
+          self.cache_filename, isolation_level=None, check_same_thread=False
+      )
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      connection.execute(
+          'CREATE TABLE IF NOT EXISTS cache (key TEXT, sample_id INTEGER,'
+          ' value TEXT, created REAL, PRIMARY KEY (key, sample_id))'
+      )
+      connection.execute(
+          'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value'
+          ' TEXT)'
+      )
+      self._connection = connection
+    return self._connection
 
+  def _insert(
+      self,
+      key_hash: str,
+      sampling_key: str | None,
+      value: CachedType,
+      key_for_logging: str,
+  ) -> None:
+    """See parent class."""
+    # The value is encoded before the cache data gets modified, so that an
+    # unserializable value leaves both the memory and the database untouched.
+    encoded_value = _encode_cached_value(value)
+    num_values = len(self._cache_data.values_by_key.get(key_hash, []))
+    num_overwrote = self._cache_data.counters['add_overwrote']
+    super()._insert(key_hash, sampling_key, value, key_for_logging)
+    values = self._cache_data.values_by_key[key_hash]
+    if len(values) > num_values:
+      # A new sample was appended.
+      sample_id = len(values) - 1
+    elif self._cache_data.counters['add_overwrote'] > num_overwrote:
+      # An existing sample was replaced.
+      sample_id = self._cache_data.sample_id_by_sampling_key_by_key[key_hash][
+          sampling_key
+      ]
+    else:
+      # The value was already stored.
+      return
+    self._get_connection().execute(
+        'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+        (
+            key_hash,
+            sample_id,
+            encoded_value,
+            time.time(),
+        ),
+    )
+
+  def load(self, restore_mapping: bool = False):
+    """See parent class."""
+    with self._lock:
+      connection = self._get_connection()
+      row = connection.execute(
+          "SELECT value FROM metadata WHERE name = 'cache_data'"
+      ).fetchone()
+      if row is None:
+        cache_data = _CacheData(hash_algo=utils.HASH_ALGO)
+      else:
+        cache_data = _CacheData.from_json(row[0], infer_missing=True)
+        cache_data.check_hash_algo(self.cache_filename)
+      self._owns_metadata = True
+      if restore_mapping:
+        logging.info('Restored sampling_key mapping from file.')
+      else:
+        logging.info('Create new sampling_key mapping.')
+        cache_data.num_used_values_by_key = collections.defaultdict(int)
+        cache_data.sample_id_by_sampling_key_by_key = (
+            nested_defaultdict_initializer()
+        )
+      decoder = self.cached_value_decoder or (lambda x: x)
+      for key_hash, value in connection.execute(
+          'SELECT key, value FROM cache ORDER BY key, sample_id'
+      ):
+        cache_data.values_by_key.setdefault(key_hash, []).append(
+            decoder(_hint_tuple_decoder(json.loads(value)))
+        )
+      self._cache_data = cache_data
+
+  def save(self, overwrite: bool = False) -> None:
+    """Writes the counters and the sampling_key mapping to the database.
+
+    The values themselves are already stored upon insertion.
+
+    Args:
+      overwrite: If False (default) we raise an error if the database already
+        contains the metadata of a cache that was neither loaded nor saved by
+        this one. If True we overwrite it.
+
+    Raises:
+      FileExistsError: If trying to overwrite the metadata of another cache.
+    """
+    with self._lock:
+      connection = self._get_connection()
+      if not overwrite and not self._owns_metadata and connection.execute(
+          "SELECT 1 FROM metadata WHERE name = 'cache_data'"
+      ).fetchone():
+        raise FileExistsError(
+            f'File {self.cache_filename} already contains a cache.'
+        )
+      # Only the (small) bookkeeping part of the cache data is written here.
+      bookkeeping = dataclasses.replace(self._cache_data, values_by_key={})
+      logging.info('Writing cache metadata to file: %s', self.cache_filename)
+      connection.execute(
+          'INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+          ('cache_data', bookkeeping.to_json()),
+      )
+      self._owns_metadata = True
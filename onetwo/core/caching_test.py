@@ -17,8 +17,12 @@ import collections
 from collections.abc import Sequence
 import copy
 import dataclasses
+import enum
+import json
 import os
 import pprint
+from typing import Any
+from unittest import mock
 
 from absl import flags
 from absl.testing import absltest
@@ -35,32 +39,46 @@ from onetwo.core import utils
 class CacheForTest(caching.SimpleCache[str]):
   """Implementation of abstract SimpleCache for tests.
 
-  Uses a tuple (key, sampling_key) as a cache key.
+  Combines key and sampling_key into a single string used as the cache key (see
+  `keys` to retrieve them).
   """
 
   def __init__(self, append_when_caching=False):
-    self.contents = {}
+    self.contents: dict[str, str | list[str]] = (
+        collections.defaultdict(list) if append_when_caching else {}
+    )
     self.append_when_caching = append_when_caching
 
+  def _composite_key(self, key: str, sampling_key: str | None) -> str:
+    # JSON keys cannot contain a null character, hence the separator.
+    return key if sampling_key is None else f'{key}\x00{sampling_key}'
+
+  def keys(self) -> list[tuple[str, str | None]]:
+    """Returns the (key, sampling_key) pairs of the stored values."""
+    pairs = []
+    for composite_key in self.contents:
+      key, separator, sampling_key = composite_key.partition('\x00')
+      pairs.append((key, sampling_key if separator else None))
+    return pairs
+
   def cache_value(
       self,
       key: str,
       sampling_key: str | None,
       value: str,
   ) -> None:
+    composite_key = self._composite_key(key, sampling_key)
     if self.append_when_caching:
-      if (key, sampling_key) not in self.contents:
-        self.contents[(key, sampling_key)] = []
-      self.contents[(key, sampling_key)].append(value)
+      self.contents[composite_key].append(value)
     else:
-      self.contents[(key, sampling_key)] = value
+      self.contents[composite_key] = value
 
   async def get_cached_value(
       self,
       key: str,
       sampling_key: str | None,
   ) -> str | None:
-    res = self.contents.get((key, sampling_key), None)
+    res = self.contents.get(self._composite_key(key, sampling_key), None)
     if res is None:
       return None
     if self.append_when_caching:
@@ -149,6 +167,16 @@ class ClassWithCachedMethods(caching.CacheEnabled[str]):
   def method_decorated_with_hash_and_kwargs(self, a: str, **extra) -> str:
     return a + extra['b']
 
+  @caching.cache_method(
+      name='method_decorated_with_custom_hash_fn',
+      is_sampled=True,
+      cache_key_maker=lambda: caching.CacheKeyMaker(
+          hashed=['a'], hash_fn=lambda value: f'hash_of_{value}'
+      ),
+  )
+  def method_decorated_with_custom_hash_fn(self, a: str, b: str) -> str:
+    return a + b
+
   @caching.cache_method(
       name='method_with_var_positional',
       is_sampled=True,
@@ -174,15 +202,20 @@ class ClassWithCachedMethods(caching.CacheEnabled[str]):
   @executing.make_executable
   @caching.cache_method(is_sampled=False)
   def method_which_returns_executable(self, text: str) -> str:
+    # The (small) sequence of updates is built upfront and simply replayed.
+    items = tuple(text[:i] for i in range(1, len(text))) + (text + ' done',)
+
     @executing.make_executable
     def stream():
-      for i in range(1, len(text)):
-        yield text[:i]
-      yield text + ' done'
+      yield from items
 
     return stream()
 
 
+class _ValueForTest(enum.Enum):
+  A = 'a'
+
+
 class SomeClass:
 
   @caching.cache_method(
@@ -197,6 +230,20 @@ class SomeClass:
 class CacheDecorationTest(parameterized.TestCase):
   """Tests cache_method with CacheKeyMaker, SimpleCache, and CacheEnabled."""
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Shared by the parameterizations of `test_cache_key`, which clear its
+    # cache before using it.
+    cls.backend = ClassWithCachedMethods()
+
+  def setUp(self):
+    super().setUp()
+    # A single event loop is reused by all the calls within a test, which is
+    # cheaper than creating one per call with `asyncio.run`.
+    self.loop = asyncio.new_event_loop()
+    self.addCleanup(self.loop.close)
+
   @parameterized.named_parameters(
       (
           'no_key_maker',
@@ -234,31 +281,72 @@ class CacheDecorationTest(parameterized.TestCase):
               (
                   f'{{"{constants.CACHING_FUNCTION_NAME_KEY}": '
                   '"method_decorated_with_hash_and_kwargs", "a":'
-                  ' "90a3ed9e32b2aaf4c61c410eb925426119e1a9dc53d4286ade99a809",'
+                  ' "6c78e0e3bd51d358d01e758642b85fb8",'
                   ' "b": " done"}'
               ),
               '',
           ),
       ),
+      (
+          'key_maker_with_custom_hash_fn',
+          'method_decorated_with_custom_hash_fn',
+          (
+              (
+                  f'{{"{constants.CACHING_FUNCTION_NAME_KEY}": '
+                  '"method_decorated_with_custom_hash_fn", "a":'
+                  ' "hash_of_test", "b": " done"}'
+              ),
+              '',
+          ),
+      ),
   )
   def test_cache_key(self, method, expected_keys):
-    backend = ClassWithCachedMethods()
-    result = asyncio.run(
+    backend = self.backend
+    handler: CacheForTest = getattr(backend, '_cache_handler')
+    handler.contents.clear()
+    result = self.loop.run_until_complete(
         getattr(ClassWithCachedMethods, method)(backend, 'test', b=' done')
     )
-    handler: CacheForTest = getattr(backend, '_cache_handler')
-    list_keys = list(handler.contents.keys())
+    list_keys = handler.keys()
     # Hint: we only have one key in the cache.
     assert len(list_keys) == 1
     keys = list_keys[0]
     self.assertEqual(keys, expected_keys)
     self.assertEqual(result, 'test done')
 
+  def test_memoized_cache_key(self):
+    key = caching._create_cache_key('f', {'b': 'x', 'a': 1})
+    with self.subTest('same_as_json_serialization'):
+      self.assertEqual(
+          key,
+          json.dumps(
+              {'b': 'x', 'a': 1, constants.CACHING_FUNCTION_NAME_KEY: 'f'},
+              sort_keys=True,
+          ),
+      )
+    with self.subTest('distinguishes_equal_values_of_different_types'):
+      self.assertNotEqual(
+          caching._create_cache_key('f', {'b': 'x', 'a': True}), key
+      )
+
+  def test_cache_key_format_is_stable(self):
+    # Cache files are indexed by hashes of these strings, so any change to the
+    # serialization (separators, escaping of non-ASCII characters, ...) would
+    # silently invalidate all existing caches.
+    key = caching._create_cache_key('f', {'a': 'é', 'b': 0.5, 'c': [1]})
+    self.assertEqual(
+        key,
+        f'{{"{constants.CACHING_FUNCTION_NAME_KEY}": "f", "a": "\\u00e9",'
+        ' "b": 0.5, "c": [1]}',
+    )
+
   def test_method_with_var_positional(self):
     backend = ClassWithCachedMethods()
-    result = asyncio.run(backend.method_with_var_positional('a', 'b', 'c'))
+    result = self.loop.run_until_complete(
+        backend.method_with_var_positional('a', 'b', 'c')
+    )
     handler: CacheForTest = getattr(backend, '_cache_handler')
-    keys = list(handler.contents.keys())
+    keys = handler.keys()
     keys = keys[0]
     self.assertEqual(
         keys,
@@ -295,7 +383,7 @@ class CacheDecorationTest(parameterized.TestCase):
         append_when_caching=True, disable_caching=disable_cache
     )
     method = 'method_decorated_with_cache_extra_replies'
-    result = asyncio.run(
+    result = self.loop.run_until_complete(
         getattr(ClassWithCachedMethods, method)(backend, 'test', b=' done')
     )
     self.assertEqual(result, 'test done')
@@ -315,13 +403,24 @@ class CacheDecorationTest(parameterized.TestCase):
       # Make sure nothing is cached.
       assert not values, pprint.pformat(handler.contents)
 
+  def test_disable_caching_does_not_create_cache_key(self):
+    backend = ClassWithCachedMethods(disable_caching=True)
+    with mock.patch.object(
+        caching.CacheKeyMaker, 'create_key', autospec=True
+    ) as mock_create_key:
+      result = self.loop.run_until_complete(
+          backend.method_decorated_with_default_cache_key_maker('test', ' done')
+      )
+    self.assertEqual(result, 'test done')
+    mock_create_key.assert_not_called()
+
   def test_does_not_return_seq_cache_extra_replies_raises_exception(self):
     backend = ClassWithCachedMethods()
     with self.assertRaisesRegex(
         ValueError,
         'Method that is decorated with cache_method(cache_extra_replies=True)*'
     ):
-      _ = asyncio.run(
+      _ = self.loop.run_until_complete(
           backend.method_does_not_return_sequence('test', b=' done')
       )
 
@@ -341,22 +440,32 @@ class CacheDecorationTest(parameterized.TestCase):
   def test_decorate_method_not_of_cacheenabled_raises_exception(self):
     backend = SomeClass()
     with self.assertRaisesRegex(ValueError, '.*inherit from CacheEnabled'):
-      _ = asyncio.run(backend.method_not_of_cacheenabled('test', b=' done'))
+      _ = self.loop.run_until_complete(
+          backend.method_not_of_cacheenabled('test', b=' done')
+      )
 
   def test_drop_keys(self):
     backend = ClassWithCachedMethods()
     results = []
     results.append(
-        asyncio.run(backend.method_with_explicit_arg(a='test', b=' done'))
+        self.loop.run_until_complete(
+            backend.method_with_explicit_arg(a='test', b=' done')
+        )
     )
     results.append(
-        asyncio.run(backend.method_with_explicit_arg(a='test2', b=' done'))
+        self.loop.run_until_complete(
+            backend.method_with_explicit_arg(a='test2', b=' done')
+        )
     )
     results.append(
-        asyncio.run(backend.method_with_implicit_arg(a='test', b=' done'))
+        self.loop.run_until_complete(
+            backend.method_with_implicit_arg(a='test', b=' done')
+        )
     )
     results.append(
-        asyncio.run(backend.method_with_implicit_arg(a='test2', b=' done'))
+        self.loop.run_until_complete(
+            backend.method_with_implicit_arg(a='test2', b=' done')
+        )
     )
     handler: CacheForTest = getattr(backend, '_cache_handler')
     values = list(handler.contents.values())
@@ -452,6 +561,8 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     # are not marked as parsed by default when running with pytest. Marking as
     # parsed directly here to make the pytest run pass.
     flags.FLAGS.mark_as_parsed()
+    self.loop = asyncio.new_event_loop()
+    self.addCleanup(self.loop.close)
 
   def test_cache_file_path_exists_raises_exception(self):
     cache_dir = self.create_tempdir()
@@ -542,7 +653,7 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     ):
       # For the existing sampling_key we get the very first value.
       self.assertEqual(
-          asyncio.run(
+          self.loop.run_until_complete(
               function_cache.get_cached_value('key1', 'sampling_key_1')
           ),
           'value_1',
@@ -560,7 +671,7 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     ):
       # For the new sampling_key we get the second value mapped.
       self.assertEqual(
-          asyncio.run(
+          self.loop.run_until_complete(
               function_cache.get_cached_value('key1', 'sampling_key_2')
           ),
           'value_4',
@@ -622,7 +733,7 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
         'get_cached_deterministic_one_value_no_sampling_key'
     ):
       self.assertEqual(
-          asyncio.run(
+          self.loop.run_until_complete(
               function_cache.get_cached_value('key_det', sampling_key_none)
           ),
           'value_1',
@@ -632,7 +743,7 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     backend = ClassCachedWithSimpleFunctionCache()
     with self.subTest('cache_decorator_properly_handles_exceptions'):
       with self.assertRaisesRegex(ValueError, 'We raise error*'):
-        _ = asyncio.run(
+        _ = self.loop.run_until_complete(
             backend.method_that_may_raise_errors(a='some', raise_error=True)
         )
     # pytype hint.
@@ -670,7 +781,9 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     function_cache.cache_value('key1', sampling_key_none, 'value_3')
     function_cache.cache_value('key1', 'sampling_key_1', 'value_4')
     function_cache.cache_value('key1', 'sampling_key_2', 'value_5')
-    _ = asyncio.run(function_cache.get_cached_value('key1', 'sampling_key_3'))
+    _ = self.loop.run_until_complete(
+        function_cache.get_cached_value('key1', 'sampling_key_3')
+    )
     function_cache.cache_value('key2', sampling_key_none, 'value_6')
     function_cache.cache_value('key2', 'sampling_key_4', 'value_7')
     function_cache.cache_value('key3', 'sampling_key_5', 'value_8')
@@ -682,11 +795,15 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     cache_1.load(restore_mapping=True)
     with self.subTest('cache_restored_properly_with_sample_mapping'):
       self.assertEqual(
-          asyncio.run(cache_1.get_cached_value('key1', 'sampling_key_2')),
+          self.loop.run_until_complete(
+              cache_1.get_cached_value('key1', 'sampling_key_2')
+          ),
           'value_2',
       )
       self.assertEqual(
-          asyncio.run(cache_1.get_cached_value('key1', 'sampling_key_1')),
+          self.loop.run_until_complete(
+              cache_1.get_cached_value('key1', 'sampling_key_1')
+          ),
           'value_1',
       )
     # Cache with fresh sample id mappings.
@@ -694,14 +811,181 @@ class SimpleFunctionCacheTest(parameterized.TestCase):
     cache_2.load(restore_mapping=False)
     with self.subTest('cache_restored_properly_with_fresh_sample_mapping'):
       self.assertEqual(
-          asyncio.run(cache_2.get_cached_value('key1', 'sampling_key_2')),
+          self.loop.run_until_complete(
+              cache_2.get_cached_value('key1', 'sampling_key_2')
+          ),
           'value_1',
       )
       self.assertEqual(
-          asyncio.run(cache_2.get_cached_value('key1', 'sampling_key_1')),
+          self.loop.run_until_complete(
+              cache_2.get_cached_value('key1', 'sampling_key_1')
+          ),
           'value_2',
       )
 
+  def test_load_from_disk_cache_with_other_hash_algo_raises(self):
+    cache_dir = self.create_tempdir()
+    cache_filename = os.path.join(cache_dir.full_path, 'my_cache.json')
+    function_cache = caching.SimpleFunctionCache(cache_filename=cache_filename)
+    function_cache.cache_value('key1', None, 'value_1')
+    function_cache.save()
+    with self.subTest('records_hash_algo'):
+      cache_1 = caching.SimpleFunctionCache(cache_filename=cache_filename)
+      cache_1.load()
+      self.assertEqual(cache_1._cache_data.hash_algo, utils.HASH_ALGO)
+    # Cache files created before hash_algo was recorded used sha224.
+    with open(cache_filename, 'w') as f:
+      f.write(json.dumps({'values_by_key': {'some_sha224_hash': ['value_1']}}))
+    with self.subTest('raises_for_legacy_file'):
+      with self.assertRaisesRegex(ValueError, 'hashed with sha224'):
+        caching.SimpleFunctionCache(cache_filename=cache_filename).load()
+
+  def test_sqlite_cache_write_to_and_load_from_disk(self):
+    cache_dir = self.create_tempdir()
+    cache_filename = os.path.join(cache_dir.full_path, 'my_cache.sqlite')
+    function_cache = caching.SqliteFunctionCache(cache_filename=cache_filename)
+    function_cache.cache_value('key1', None, 'value_1')
+    # Gets mapped to the (so far unused) first sample.
+    function_cache.cache_value('key1', 'sampling_key_1', 'value_2')
+    function_cache.cache_value('key1', 'sampling_key_2', ('value_3', 'a'))
+    # Overwrites the value stored for sampling_key_1.
+    function_cache.cache_value('key1', 'sampling_key_1', 'value_4')
+    function_cache.cache_value('key2', 'sampling_key_3', ['value_5'])
+    with self.subTest('values_are_written_before_save'):
+      cache_1 = caching.SqliteFunctionCache(cache_filename=cache_filename)
+      cache_1.load()
+      self.assertEqual(
+          cache_1._cache_data.values_by_key,
+          function_cache._cache_data.values_by_key,
+      )
+
+    function_cache.save()
+    cache_2 = caching.SqliteFunctionCache(cache_filename=cache_filename)
+    cache_2.load(restore_mapping=True)
+    with self.subTest('cache_restored_properly_with_sample_mapping'):
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_2.get_cached_value('key1', 'sampling_key_2')
+          ),
+          'value_2',
+      )
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_2.get_cached_value('key1', 'sampling_key_1')
+          ),
+          'value_4',
+      )
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_2.get_cached_value('key2', 'sampling_key_3')
+          ),
+          ['value_5'],
+      )
+
+    cache_3 = caching.SqliteFunctionCache(cache_filename=cache_filename)
+    cache_3.load(restore_mapping=False)
+    with self.subTest('cache_restored_properly_with_fresh_sample_mapping'):
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_3.get_cached_value('key1', 'sampling_key_2')
+          ),
+          'value_4',
+      )
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_3.get_cached_value('key1', 'sampling_key_1')
+          ),
+          'value_2',
+      )
+      self.assertEqual(
+          self.loop.run_until_complete(
+              cache_3.get_cached_value('key1', 'sampling_key_3')
+          ),
+          ('value_3', 'a'),
+      )
+
+  def test_sqlite_cache_encodes_values_like_json_cache(self):
+    cache_dir = self.create_tempdir()
+    # Enum values are not supported by `json` but by dataclasses_json.
+    value = ['value_1', _ValueForTest.A, ('a', 'b')]
+    json_filename = os.path.join(cache_dir.full_path, 'my_cache.json')
+    json_cache = caching.SimpleFunctionCache(cache_filename=json_filename)
+    json_cache.cache_value('key1', None, value)
+    json_cache.save()
+    json_cache.load()
+    sqlite_filename = os.path.join(cache_dir.full_path, 'my_cache.sqlite')
+    with caching.SqliteFunctionCache(
+        cache_filename=sqlite_filename
+    ) as sqlite_cache:
+      sqlite_cache.cache_value('key1', None, value)
+      sqlite_cache.load()
+    self.assertEqual(
+        sqlite_cache._cache_data.values_by_key,
+        json_cache._cache_data.values_by_key,
+    )
+
+  def test_sqlite_cache_save_overwrite(self):
+    cache_dir = self.create_tempdir()
+    cache_filename = os.path.join(cache_dir.full_path, 'my_cache.sqlite')
+    with caching.SqliteFunctionCache(cache_filename=cache_filename) as cache_1:
+      cache_1.cache_value('key1', None, 'value_1')
+      cache_1.save()
+      with self.subTest('saves_again_own_metadata'):
+        cache_1.save()
+    with caching.SqliteFunctionCache(cache_filename=cache_filename) as cache_2:
+      with self.subTest('raises_for_metadata_of_other_cache'):
+        with self.assertRaises(FileExistsError):
+          cache_2.save()
+      with self.subTest('overwrites_if_requested'):
+        cache_2.save(overwrite=True)
+    with caching.SqliteFunctionCache(cache_filename=cache_filename) as cache_3:
+      cache_3.load()
+      with self.subTest('saves_loaded_metadata'):
+        cache_3.save()
+    with self.subTest('closes_connection'):
+      self.assertIsNone(cache_3._connection)
+
+  def test_sqlite_cache_does_not_store_unserializable_value(self):
+    cache_dir = self.create_tempdir()
+    cache_filename = os.path.join(cache_dir.full_path, 'my_cache.sqlite')
+    function_cache = caching.SqliteFunctionCache(cache_filename=cache_filename)
+    function_cache.cache_value('key1', None, 'value_1')
+    with self.assertRaises(TypeError):
+      function_cache.cache_value('key1', 'sampling_key_1', object())
+    cache_1 = caching.SqliteFunctionCache(cache_filename=cache_filename)
+    cache_1.load()
+    with self.subTest('memory_is_unchanged'):
+      self.assertEqual(
+          function_cache._cache_data.values_by_key,
+          {utils.get_str_hash('key1'): ['value_1']},
+      )
+    with self.subTest('database_matches_memory'):
+      self.assertEqual(
+          cache_1._cache_data.values_by_key,
+          function_cache._cache_data.values_by_key,
+      )
+
+  def test_failure_to_store_value_unblocks_identical_calls(self):
+    cache_dir = self.create_tempdir()
+
+    @dataclasses.dataclass
+    class C(caching.CacheEnabled[Any]):
+
+      def __post_init__(self):
+        self._cache_handler = caching.SqliteFunctionCache(
+            cache_filename=os.path.join(cache_dir.full_path, 'c.sqlite')
+        )
+
+      @caching.cache_method()
+      async def f(self, a: str) -> Any:
+        del a
+        return object()  # Can not be serialized to JSON.
+
+    c = C()
+    with self.assertRaises(TypeError):
+      self.loop.run_until_complete(c.f('a'))
+    self.assertEmpty(c._cache_handler._calls_in_progress)
+
 
 class CacheDataTest(parameterized.TestCase):
   """Tests _CacheData class."""
@@ -20,7 +20,6 @@ from collections.abc import AsyncIterator, Awaitable, Callable, Mapping
 import copy
 import dataclasses
 import functools
-import hashlib
 import inspect
 import io
 import threading
@@ -29,6 +28,7 @@ from typing import cast, overload, Any, Concatenate, Final, Generic, ParamSpec,
 
 from onetwo.core import content as content_lib
 import PIL.Image
+import xxhash
 
 _T = TypeVar('_T')
 _Args = ParamSpec('_Args')
@@ -120,6 +120,7 @@ def get_expanded_arguments(
     include_defaults: bool,
     args: tuple[Any, ...],
     kwargs: Mapping[str, Any],
+    signature: inspect.Signature | None = None,
 ) -> collections.OrderedDict[str, Any]:
   """Expands the arguments to the function.
 
@@ -136,6 +137,9 @@ def get_expanded_arguments(
       set by the caller.
     args: Positional arguments used in the call to the function.
     kwargs: Keyword arguments used in the call to the function.
+    signature: The signature of f if already known. Computing it is relatively
+      expensive (in particular for decorated functions), hence decorators
+      should compute it once at decoration time and pass it here.
 
   Returns:
     An ordered dict of {argument_name: argument_value} extracted from the
@@ -145,7 +149,8 @@ def get_expanded_arguments(
     In order to call the function, one needs to use get_calling_args_and_kwargs,
     which converts the ordered dict into a pair (args, kwargs).
   """
-  signature = inspect.signature(f)
+  if signature is None:
+    signature = inspect.signature(f)
   bound_signature = signature.bind_partial(*args)
   if bound_signature is None:
     result = {}
@@ -318,6 +323,78 @@ def rate_limit_function(
   return decorate
 
 
+@dataclasses.dataclass
+class TokenBucket:
+  """Thread-safe token bucket rate limiter.
+
+  Contrary to `rate_limit_function` and `rate_limit_method`, which space out
+  every call by 1/qps seconds, a token bucket allows bursts of up to `capacity`
+  calls to go through without waiting, while still limiting the average rate to
+  `rate` calls per second.
+
+  Usage example:
+  ```
+  bucket = TokenBucket(rate=10.0, capacity=10.0)
+
+  async def call_api(request):
+    await bucket.acquire()
+    ...
+  ```
+
+  Attributes:
+    rate: Number of tokens added to the bucket per second (i.e. the sustained
+      number of calls per second).
+    capacity: Maximum number of tokens the bucket can hold (i.e. the maximum
+      number of calls that can be made in a burst). The bucket starts full.
+  """
+
+  rate: float
+  capacity: float
+  _tokens: float = dataclasses.field(init=False)
+  _last_refill: float = dataclasses.field(init=False)
+  _lock: threading.Lock = dataclasses.field(
+      init=False, default_factory=threading.Lock
+  )
+
+  def __post_init__(self):
+    if self.rate <= 0 or self.capacity <= 0:
+      raise ValueError(
+          'TokenBucket rate and capacity should be positive, got'
+          f' rate={self.rate}, capacity={self.capacity}.'
+      )
+    self._tokens = self.capacity
+    self._last_refill = time.perf_counter()
+
+  def _reserve(self, n: float) -> float:
+    """Takes n tokens from the bucket and returns the time to wait for them."""
+    with self._lock:
+      current = time.perf_counter()
+      self._tokens = min(
+          self.capacity,
+          self._tokens + (current - self._last_refill) * self.rate,
+      )
+      self._last_refill = current
+      # The number of tokens may become negative, in which case the caller has
+      # to wait until the bucket is refilled. Subsequent callers will have to
+      # wait for longer.
+      self._tokens -= n
+      if self._tokens >= 0:
+        return 0.0
+      return -self._tokens / self.rate
+
+  def acquire_blocking(self, n: float = 1) -> None:
+    """Blocks until n tokens are available and takes them from the bucket."""
+    wait = self._reserve(n)
+    if wait > 0:
+      time.sleep(wait)
+
+  async def acquire(self, n: float = 1) -> None:
+    """Waits (without blocking) until n tokens are available and takes them."""
+    wait = self._reserve(n)
+    if wait > 0:
+      await asyncio.sleep(wait)
+
+
 def rate_limit_method(
     qps: float | None | FromInstance[float | None],
 ) -> Callable[[Callable[_Args, _T]], Callable[_Args, _T]]:
@@ -539,8 +616,8 @@ def raising_returned_exception(function):
       return wrapper
 
 
-def _get_bytes_for_hashing(key: Any) -> bytes:
-  """Best-effort conversion of key to bytes for further hashing."""
+def _get_bytes_for_hashing(key: Any) -> bytes | memoryview:
+  """Best-effort conversion of key to bytes (or a view on them) for hashing."""
   match key:
     # The `hash` function for python `str` and `bytes` by default (starting
     # from python 3.3) adds a random seed to the hash. This means that between
@@ -562,25 +639,56 @@ def _get_bytes_for_hashing(key: Any) -> bytes:
       bytes_io = io.BytesIO()
       cast(PIL.Image.Image, key).save(bytes_io, 'JPEG')
       bytes_value = bytes_io.getvalue()
-    case content_lib.Chunk():
-      bytes_value = _get_bytes_for_hashing(key.content)
-    case content_lib.ChunkList():
-      bytes_value = b''.join(
-          [_get_bytes_for_hashing(chunk) for chunk in key.chunks]
-      )
     # case Hashable():
     #   Let us never add this case! This means we want to rely on `__hash__`
     #   method of the type, but as pointed out above doing so is often
     #   dangerous.
     case _:
       if hasattr(key, 'tobytes'):  # Type `str` has no such attribute.
-        # This handles the case of a np.ndarray.
-        bytes_value = key.tobytes()
+        # This handles the case of a np.ndarray. The data of C-contiguous
+        # arrays is hashed through a memoryview, which produces the same bytes
+        # as `tobytes` without copying them. Some dtypes (e.g. datetime64) do
+        # not support the buffer protocol and raise a ValueError.
+        try:
+          view = memoryview(key)
+        except (TypeError, BufferError, ValueError):
+          view = None
+        if view is not None and view.c_contiguous:
+          bytes_value = view
+        else:
+          bytes_value = key.tobytes()
       else:
         raise ValueError(f'Unsupported key type: {type(key)}')
   return bytes_value
 
 
+def _update_hash(hasher: Any, key: Any) -> None:
+  """Feeds the bytes of key into hasher (anything with an `update` method).
+
+  Chunks of a ChunkList are fed one by one, which yields the same digest as
+  hashing their concatenation without materializing it.
+
+  Args:
+    hasher: Incremental hash object (e.g. from `hashlib` or `xxhash`).
+    key: Object to be hashed.
+  """
+  match key:
+    case content_lib.Chunk():
+      _update_hash(hasher, key.content)
+    case content_lib.ChunkList():
+      for chunk in key.chunks:
+        _update_hash(hasher, chunk)
+    case _:
+      hasher.update(_get_bytes_for_hashing(key))
+
+
+# Name of the algorithm used by `get_str_hash`. Changing it changes the keys of
+# all the cached values, which is why it is recorded in the cache files (see
+# `caching._CacheData`): files whose keys were hashed with another algorithm
+# are rejected when loaded.
+HASH_ALGO: Final[str] = 'xxh3_128'
+
+
 def get_str_hash(key: Any) -> str:
   """Best-effort hashing of various kinds of objects.
 
@@ -595,5 +703,7 @@ def get_str_hash(key: Any) -> str:
     `caching.py` is that identical calls to the cached functions end up being
     properly recognized.
   """
-  bytes_value = _get_bytes_for_hashing(key)
-  return hashlib.sha224(bytes_value).hexdigest()
+  # Non-cryptographic, and more than 10x faster than sha224 on large inputs.
+  hasher = xxhash.xxh3_128()
+  _update_hash(hasher, key)
+  return hasher.hexdigest()
@@ -15,9 +15,10 @@
 import asyncio
 import copy
 import functools
+import inspect
 import multiprocessing.pool
 import time
-from typing import TypeAlias
+from typing import Any, TypeAlias
 
 from absl.testing import absltest
 from absl.testing import parameterized
@@ -31,6 +32,19 @@ _Chunk: TypeAlias = content_lib.Chunk
 _ChunkList: TypeAlias = content_lib.ChunkList
 
 
+def _fast_copy(value: Any) -> Any:
+  """Returns a copy of value, avoiding deepcopy for flat containers."""
+  match value:
+    case np.ndarray():
+      return value.copy()
+    case dict() | list() | set():
+      # The elements are immutable in the cases tested, which is why a shallow
+      # copy is enough.
+      return type(value)(value)
+    case _:
+      return copy.deepcopy(value)
+
+
 def f_empty():
   return None
 
@@ -159,6 +173,14 @@ class UtilsTest(parameterized.TestCase):
     with self.subTest('should_return_correct_result'):
       self.assertEqual(result, expected)
 
+    with self.subTest('should_return_same_result_with_precomputed_signature'):
+      self.assertEqual(
+          utils.get_expanded_arguments(
+              fun, use_defaults, args, kwargs, inspect.signature(fun)
+          ),
+          expected,
+      )
+
     with self.subTest('should_give_the_right_return_value'):
       direct_res = direct_call(fun, args, kwargs)
       self.assertEqual(direct_res, expected_call_res)
@@ -301,6 +323,42 @@ class UtilsTest(parameterized.TestCase):
       # We run 20 queries with 2qps, it should take no less than 9.5s.
       self.assertLess(9.5, end - start)
 
+  def test_token_bucket(self):
+    bucket = utils.TokenBucket(rate=2.0, capacity=4.0)
+
+    start = time.perf_counter()
+    for _ in range(4):
+      bucket.acquire_blocking()
+    end = time.perf_counter()
+
+    with self.subTest('should_not_limit_bursts_within_capacity'):
+      self.assertLess(end - start, 0.5)
+
+    start = time.perf_counter()
+    for _ in range(4):
+      bucket.acquire_blocking()
+    end = time.perf_counter()
+
+    with self.subTest('should_limit_blocking_calls_beyond_capacity'):
+      # The bucket is empty, 4 calls at 2qps should take ~2s.
+      self.assertBetween(end - start, 1.5, 2.5)
+
+    async def plan():
+      await asyncio.sleep(2.0)  # Refill the bucket.
+      start = time.perf_counter()
+      await asyncio.gather(*[bucket.acquire() for _ in range(8)])
+      return time.perf_counter() - start
+
+    duration = asyncio.run(plan())
+
+    with self.subTest('should_limit_async_calls'):
+      # 4 calls go through immediately, and the remaining 4 take ~2s.
+      self.assertBetween(duration, 1.5, 2.5)
+
+    with self.subTest('should_raise_for_invalid_rate'):
+      with self.assertRaisesRegex(ValueError, 'should be positive'):
+        _ = utils.TokenBucket(rate=0.0, capacity=1.0)
+
   def test_rate_limit_method(self):
     class ClassForTest:
       @utils.rate_limit_method(2.0)
@@ -378,24 +436,51 @@ class UtilsTest(parameterized.TestCase):
           np.array([1, 2, 3]),
           np.array([3, 2, 1]),
       ),
+      (
+          # Non-contiguous arrays are hashed like their contiguous copies.
+          'np.array_not_contiguous',
+          np.arange(6).reshape(2, 3).T,
+          np.array([[0, 3], [1, 4], [2, 5]]),
+          np.arange(6).reshape(3, 2),
+      ),
+      (
+          # Arrays of these dtypes do not support memoryview.
+          'np.array_datetime64',
+          np.array(['2024-01-01', '2024-01-02'], dtype='datetime64[D]'),
+          np.array(['2024-01-01', '2024-01-02'], dtype='datetime64[D]'),
+          np.array(['2024-01-02', '2024-01-01'], dtype='datetime64[D]'),
+      ),
+      (
+          'np.array_timedelta64',
+          np.array([1, 2], dtype='timedelta64[s]'),
+          np.array([1, 2], dtype='timedelta64[s]'),
+          np.array([2, 1], dtype='timedelta64[s]'),
+      ),
   )
   def test_get_hash(self, key, similar_key, other_key):
     # We create a simple copy of the key.
-    c = copy.deepcopy(key)
+    c = _fast_copy(key)
     key_hash = utils.get_str_hash(key)
     copy_hash = utils.get_str_hash(c)
     similar_hash = utils.get_str_hash(similar_key)
     other_hash = utils.get_str_hash(other_key)
     # We check we obtain the same hash (this is not a very strong test
     # as ideally one would compare hashes on different machines etc... but
-    # this is a first attempt at checking that some reasonable hash is created).
+    # this is a first attempt at checking that some reasonable hash is
+    # created).
     self.assertEqual(copy_hash, key_hash)
     self.assertEqual(similar_hash, key_hash)
     # We also check that the hashes are different for different keys (this
-    # would catch mistakes such as accidentally mapping all keys to the same
-    # hash).
+    # would catch mistakes such as accidentally mapping all keys to the
+    # same hash).
     self.assertNotEqual(other_hash, key_hash)
 
+  def test_get_hash_of_chunk_list_matches_concatenated_content(self):
+    chunk_list = _ChunkList(chunks=[_Chunk('ab'), _Chunk(b'cd'), _Chunk('ef')])
+    self.assertEqual(
+        utils.get_str_hash(chunk_list), utils.get_str_hash('abcdef')
+    )
+
   def test_is_method(self):
     results = {}
 